@@ -1,8 +1,95 @@
-import random, time
+import gc, heapq, random, time
 
 import array
 
 
+# save_state layout: a 4 byte header (magic, version, reserved) followed by the
+# machine state at fixed offsets
+STATE_MAGIC = b"C8"
+STATE_VERSION = 4
+STATE_MEMORY = 4
+STATE_V = STATE_MEMORY + 4096
+STATE_I = STATE_V + 16
+STATE_PC = STATE_I + 2
+STATE_SP = STATE_PC + 2
+STATE_STACK = STATE_SP + 1
+STATE_TIMERS = STATE_STACK + 32
+STATE_KEYPAD = STATE_TIMERS + 2
+STATE_MODE = STATE_KEYPAD + 16
+STATE_AUDIO = STATE_MODE + 1  # XO-CHIP pattern, pitch, pattern in use
+STATE_RNG = STATE_AUDIO + 18  # CXNN generator state
+STATE_SCREEN = STATE_RNG + 2
+STATE_SIZE = STATE_SCREEN + 64 * 16
+
+
+# CHIP-8 variants disagree on a few instructions. Each quirk is off in "default",
+# which is how this emulator has always behaved:
+#   shift_vy           8XY6/8XYE shift VY into VX instead of shifting VX in place
+#   load_store_keep_i  FX55/FX65 leave I unchanged instead of advancing it past VX
+#   clip_columns       sprites are clipped at the right edge instead of wrapping around
+#                      to the left
+#   wrap_rows          sprites wrap around the bottom edge instead of being clipped there
+#   jump_vx            BNNN jumps to XNN + VX instead of NNN + V0
+QUIRK_PROFILES = {
+    "default": {
+        "shift_vy": False,
+        "load_store_keep_i": False,
+        "clip_columns": False,
+        "wrap_rows": False,
+        "jump_vx": False,
+    },
+    "chip8": {
+        "shift_vy": True,
+        "load_store_keep_i": False,
+        "clip_columns": True,
+        "wrap_rows": False,
+        "jump_vx": False,
+    },
+    "schip": {
+        "shift_vy": False,
+        "load_store_keep_i": True,
+        "clip_columns": True,
+        "wrap_rows": False,
+        "jump_vx": True,
+    },
+    "xochip": {
+        "shift_vy": True,
+        "load_store_keep_i": False,
+        "clip_columns": False,
+        "wrap_rows": True,
+        "jump_vx": False,
+    },
+}
+
+
+# ticks_ms() wraps around on MicroPython, so key times are compared with ticks_diff;
+# elsewhere (e.g. chip8_bench's shim) the ticks are plain integers
+if hasattr(time, "ticks_diff"):
+    ticks_add = time.ticks_add
+    ticks_diff = time.ticks_diff
+else:
+    def ticks_add(ticks, delta):
+        return ticks + delta
+
+    def ticks_diff(end, start):
+        return end - start
+
+
+class CpuIdle(Exception):
+    """
+    Raised by an idle loop's jump or a halting FX0A to end the current batch early.
+
+    Each Chip8 raises the same instance every time. CPython adds the frames of every
+    raise to its __traceback__, so the handlers call release() to let them go.
+    """
+
+    def release(self):
+        try:
+            self.__traceback__ = None
+        except AttributeError:
+            # ports without tracebacks on exceptions have nothing to release
+            pass
+
 
 class Chip8:
     """
@@ -18,9 +105,10 @@ class Chip8:
         sp (int): The stack pointer.
         stack (list): The stack for subroutine calls.
         pc (int): The program counter.
-        delay_timer (int): The delay timer.
-        sound_timer (int): The sound timer.
-        screen (bytearray): The display buffer.
+        delay_timer (int): The delay timer, worked out from delay_deadline when read.
+        sound_timer (int): The sound timer, worked out from sound_deadline when read.
+        screen (list): The display buffer, one int per row with column 0 in the top bit
+            (64 bits wide, or 128 in SUPER-CHIP hi-res mode).
         keypad (list): The keypad state.
         display_dirty (bool): Flag indicating if the display needs to be updated.
         key_map (dict): Mapping of physical keys to Chip-8 key codes.
@@ -32,10 +120,10 @@ class Chip8:
         screen_height,
         draw_pixel_callback=None,
         play_audio_callback=None,
+        draw_span_callback=None,
+        draw_byte_callback=None,
     ):
 
-        self.experimental_optimization = True
-
         # host device settings
         self.width = screen_width
         self.height = screen_height
@@ -47,22 +135,69 @@ class Chip8:
         self.i = 0
         self.pc = 0x200
 
-        # Stack and timers
+        # Stack and timers. The timers are kept as the tick at which they reach zero
+        # (see timer_ticks), so nothing has to count them down
         self.stack = [0] * 16
         self.sp = 0
-        self.delay_timer = 0
-        self.sound_timer = 0
-
-        # Display
-        self.screen = self.get_clear_screen_bytes()
+        self.delay_deadline = 0
+        self.sound_deadline = 0
+        self.tick_base = 0
+        self.tick_base_cycle = 0
+
+        # Display, allocated for the 128x64 hi-res mode; only the first `rows` rows and
+        # `columns` bits of each are in use
+        self.hires = False
+        self.columns = 64
+        self.rows = 32
+        self.row_mask = 0xFFFFFFFFFFFFFFFF
+        self.screen = [0] * 64
+
+        # rows as last sent to the frontend, plus the column span of each row touched
+        # since then (dirty_lo > dirty_hi means the row is clean)
+        self.presented = [0] * 64
+        self.dirty_lo = bytearray(b"\xff" * 64)
+        self.dirty_hi = bytearray(64)
+        self.redraw_all = True
+
+        # called with (columns, rows) after 00FE/00FF switch the resolution
+        self.resolution_callback = None
 
         # Keypad
         self.keypad = [False] * 16
         self.key_timestamps = [0] * 16
         self.key_delay = 200  # key release delay in milliseconds
 
+        # release keys key_delay ms after they were pressed (for hosts without key-up events)
+        self.auto_release = True
+
+        # (release time, key) for every auto-released press, checked at frame boundaries
+        self.release_queue = []
+
+        # register FX0A is waiting to load a key into, -1 while the CPU is running
+        self.key_wait = -1
+
+        # (cycle, key, pressed, timestamp) key events, applied by run_cycles at their cycle
+        self.input_queue = []
+
+        # input latency in ms per key press while set_latency_tracking(True) is active,
+        # and the timestamps of presses applied but not presented yet
+        self.latency_samples = None
+        self.latency_pending = []
+
+        # packed key changes while recording input, see chip8_replay
+        self.input_log = None
+
+        # instructions executed since reset, the time base for recorded input
+        self.cycles = 0
+
+        self.seed(random.getrandbits(16))
+
         self.display_dirty = False
 
+        # unknown opcodes executed so far, and the most recent one
+        self.unknown_opcode_count = 0
+        self.last_unknown_opcode = None
+
         # Sample fontset
         self.fontset = [
             0xF0,
@@ -150,92 +285,263 @@ class Chip8:
             "V": 0xE,
         }
 
-        # self.opcode_handlers = {
-        #     0x0000: handle_0000,
-        #     0x1000: handle_1000,
-        #     0x2000: handle_2000,
-        # }
-
-        # self.opcode_handlers = {
-        #     0: lambda opcode: self.handle_0x0000(opcode),
-        #     1: lambda opcode: self.handle_0x1000(opcode),
-        #     2: lambda opcode: self.handle_0x2000(opcode),
-        #     3: lambda opcode: self.handle_0x3000(opcode),
-        #     4: lambda opcode: self.handle_0x4000(opcode),
-        #     5: lambda opcode: self.handle_0x5000(opcode),
-        #     6: lambda opcode: self.handle_0x6000(opcode),
-        #     7: lambda opcode: self.handle_0x7000(opcode),
-        #     8: lambda opcode: self.handle_0x8000(opcode),
-        #     9: lambda opcode: self.handle_0x9000(opcode),
-        #     10: lambda opcode: self.handle_0xA000(opcode),
-        #     11: lambda opcode: self.handle_0xB000(opcode),
-        #     12: lambda opcode: self.handle_0xC000(opcode),
-        #     13: lambda opcode: self.handle_0xD000(opcode),
-        #     14: lambda opcode: self.handle_0xE000(opcode),
-        #     15: lambda opcode: self.handle_0xF000(opcode)
-        # }
-
-        self.opcode_handlers = {
-            0x0000: lambda opcode: self.handle_0x0000(opcode),
-            0x1000: lambda opcode: self.handle_0x1000(opcode),
-            0x2000: lambda opcode: self.handle_0x2000(opcode),
-            0x3000: lambda opcode: self.handle_0x3000(opcode),
-            0x4000: lambda opcode: self.handle_0x4000(opcode),
-            0x5000: lambda opcode: self.handle_0x5000(opcode),
-            0x6000: lambda opcode: self.handle_0x6000(opcode),
-            0x7000: lambda opcode: self.handle_0x7000(opcode),
-            0x8000: lambda opcode: self.handle_0x8000(opcode),
-            0x9000: lambda opcode: self.handle_0x9000(opcode),
-            0xA000: lambda opcode: self.handle_0xA000(opcode),
-            0xB000: lambda opcode: self.handle_0xB000(opcode),
-            0xC000: lambda opcode: self.handle_0xC000(opcode),
-            0xD000: lambda opcode: self.handle_0xD000(opcode),
-            0xE000: lambda opcode: self.handle_0xE000(opcode),
-            0xF000: lambda opcode: self.handle_0xF000(opcode)
+        # instruction handler factories by name (see decode_opcode)
+        self.handlers = {
+            "00e0": self.op_00e0,
+            "00ee": self.op_00ee,
+            "00cn": self.op_00cn,
+            "00fb": self.op_00fb,
+            "00fc": self.op_00fc,
+            "00fd": self.op_00fd,
+            "00fe": self.op_00fe,
+            "00ff": self.op_00ff,
+            "1nnn": self.op_1nnn,
+            "2nnn": self.op_2nnn,
+            "3xnn": self.op_3xnn,
+            "4xnn": self.op_4xnn,
+            "5xy0": self.op_5xy0,
+            "6xnn": self.op_6xnn,
+            "7xnn": self.op_7xnn,
+            "8xy0": self.op_8xy0,
+            "8xy1": self.op_8xy1,
+            "8xy2": self.op_8xy2,
+            "8xy3": self.op_8xy3,
+            "8xy4": self.op_8xy4,
+            "8xy5": self.op_8xy5,
+            "8xy6": self.op_8xy6,
+            "8xy7": self.op_8xy7,
+            "8xye": self.op_8xye,
+            "9xy0": self.op_9xy0,
+            "annn": self.op_annn,
+            "bnnn": self.op_bnnn,
+            "cxnn": self.op_cxnn,
+            "dxyn": self.op_dxyn,
+            "ex9e": self.op_ex9e,
+            "exa1": self.op_exa1,
+            "fx07": self.op_fx07,
+            "fx02": self.op_fx02,
+            "fx0a": self.op_fx0a,
+            "fx15": self.op_fx15,
+            "fx18": self.op_fx18,
+            "fx3a": self.op_fx3a,
+            "fx1e": self.op_fx1e,
+            "fx29": self.op_fx29,
+            "fx33": self.op_fx33,
+            "fx55": self.op_fx55,
+            "fx65": self.op_fx65,
+            "unknown": self.op_unknown,
+            "idle": self.op_idle,
+        }
+
+        # execute(pc) closures per program address, filled lazily by decode()
+        self.decoded = [None] * 4096
+
+        # compiled blocks per start address and the bytes they were built from
+        self.blocks = [None] * 4096
+        self.block_starts = []
+        self.block_lengths = bytearray(4096)
+        self.block_map = bytearray(4096)
+
+        # Python source emitted by the recompiler for each straight-line instruction.
+        # %(a)d, %(b)d and %(c)d are the decoded operands.
+        self.block_code = {
+            "6xnn": ["v[%(a)d] = %(b)d"],
+            "7xnn": ["v[%(a)d] = (v[%(a)d] + %(b)d) & 0xFF"],
+            "8xy0": ["v[%(a)d] = v[%(b)d]"],
+            "8xy1": ["v[%(a)d] |= v[%(b)d]"],
+            "8xy2": ["v[%(a)d] &= v[%(b)d]"],
+            "8xy3": ["v[%(a)d] ^= v[%(b)d]"],
+            "8xy4": ["t = v[%(a)d] + v[%(b)d]", "v[%(a)d] = t & 0xFF", "v[0xF] = t >> 8"],
+            "8xy5": ["v[0xF] = 1 if v[%(a)d] > v[%(b)d] else 0", "v[%(a)d] = (v[%(a)d] - v[%(b)d]) & 0xFF"],
+            "8xy6": ["v[0xF] = v[%(a)d] & 0x1", "v[%(a)d] >>= 1"],
+            "8xy7": ["v[0xF] = 1 if v[%(b)d] > v[%(a)d] else 0", "v[%(a)d] = (v[%(b)d] - v[%(a)d]) & 0xFF"],
+            "8xye": ["v[0xF] = (v[%(a)d] & 0x80) >> 7", "v[%(a)d] = (v[%(a)d] << 1) & 0xFF"],
+            "annn": ["self.i = %(a)d"],
+            "fx1e": ["self.i = (self.i + v[%(a)d]) & 0xFFFF"],
+        }
+
+        # Python source for the instructions that end a block; %(pc)d is the address of the
+        # instruction itself and the code must return the next pc.
+        self.block_exit_code = {
+            "00ee": ["self.sp -= 1", "return stack[self.sp]"],
+            "1nnn": ["return %(a)d"],
+            "2nnn": ["stack[self.sp] = %(pc)d + 2", "self.sp += 1", "return %(a)d"],
+            "3xnn": ["if v[%(a)d] == %(b)d:", "    return %(pc)d + 4", "return %(pc)d + 2"],
+            "4xnn": ["if v[%(a)d] != %(b)d:", "    return %(pc)d + 4", "return %(pc)d + 2"],
+            "5xy0": ["if v[%(a)d] == v[%(b)d]:", "    return %(pc)d + 4", "return %(pc)d + 2"],
+            "9xy0": ["if v[%(a)d] != v[%(b)d]:", "    return %(pc)d + 4", "return %(pc)d + 2"],
+            "bnnn": ["return %(a)d + v[0]"],
+            "dxyn": ["draw_sprite(%(a)d, %(b)d, %(c)d)", "return %(pc)d + 2"],
+            "ex9e": ["if self.keypad[v[%(a)d]]:", "    return %(pc)d + 4", "return %(pc)d + 2"],
+            "exa1": ["if not self.keypad[v[%(a)d]]:", "    return %(pc)d + 4", "return %(pc)d + 2"],
+        }
+
+        # longest run of instructions compiled into a single block
+        self.max_block_length = 32
+
+        # compiled block factories by generated source, kept across cache flushes
+        self.block_factories = {}
+
+        # instructions whose behaviour depends on a quirk, as (quirk, handler key, plain
+        # handler, quirk handler); set_quirks installs one of the two
+        self.quirk_variants = [
+            ("shift_vy", "8xy6", self.op_8xy6, self.op_8xy6_vy),
+            ("shift_vy", "8xye", self.op_8xye, self.op_8xye_vy),
+            ("load_store_keep_i", "fx55", self.op_fx55, self.op_fx55_keep_i),
+            ("load_store_keep_i", "fx65", self.op_fx65, self.op_fx65_keep_i),
+            ("jump_vx", "bnnn", self.op_bnnn, self.op_bxnn),
+        ]
+
+        # recompiler source for the quirk variants, and the plain source they replace
+        self.quirk_block_code = {
+            "8xy6": ["t = v[%(b)d]", "v[%(a)d] = t >> 1", "v[0xF] = t & 0x1"],
+            "8xye": ["t = v[%(b)d]", "v[%(a)d] = (t << 1) & 0xFF", "v[0xF] = t >> 7"],
+            "bnnn": ["return %(a)d + v[%(a)d >> 8]"],
+        }
+        self.plain_block_code = {
+            "8xy6": self.block_code["8xy6"],
+            "8xye": self.block_code["8xye"],
+            "bnnn": self.block_exit_code["bnnn"],
         }
 
+        # sprite drawing for the current sprite quirks, see sprite_drawer and set_quirks
+        self.draw_sprite = self.sprite_drawer(False, False)
+        self.quirks = QUIRK_PROFILES["default"]
+
+        # "interpreter" dispatches one cached instruction at a time, "recompiler" runs
+        # compiled basic blocks (see set_engine)
+        self.engine = "interpreter"
+
+        # instructions the recompiler ran past the end of its last batch, taken off the
+        # next one so it keeps the interpreter's pace (see run_blocks)
+        self.cycle_debt = 0
 
+        # jumps that can only spin until the next timer tick end the batch early (see
+        # is_idle_loop); idle is set when the last batch ended that way
+        self.idle_detection = True
+        self.idle = False
+        self.idle_signal = CpuIdle()
+
+        # profiling data while set_profiling(True) is active, see profile_snapshot
+        self.profile = None
+        self.pc_histogram = None
 
         self.is_sound_playing = False
 
+        # FX18 started a sound this frame; update_timers plays it for at least one frame
+        self.sound_started = False
+
+        # XO-CHIP audio: the 16-byte (128 one-bit samples) pattern loaded by F002 and the
+        # pitch register set by FX3A. xo_audio tells the frontend to play the pattern
+        # instead of its plain beep; audio_changed that either changed since it last heard
+        self.audio_pattern = bytearray(16)
+        self.audio_pitch = 64
+        self.xo_audio = False
+        self.audio_changed = False
+
         self.clock_cycle_interval = 1
 
+        # instructions executed per host frame by run_frame (~600 per second at 60 fps)
+        self.instructions_per_frame = 10
+
+        # instructions per 60 Hz timer tick; run_frame keeps this at its batch size
+        self.cycles_per_tick = self.instructions_per_frame
+
+        # fast-forward: emulated frames per host frame, and present every Nth host frame
+        self.turbo = 1
+        self.frame_skip = 1
+        self.frame_count = 0
+
         self.draw_pixel_callback = draw_pixel_callback
 
+        # optional draw_span_callback(x, y, length, on), used instead of
+        # draw_pixel_callback to draw a horizontal run of identical pixels in one go
+        self.draw_span_callback = draw_span_callback
+
+        # optional draw_byte_callback(column, y, bits), used instead of both: draws the
+        # 8 pixels at x = column * 8 .. column * 8 + 7 from one byte, leftmost in bit 7
+        self.draw_byte_callback = draw_byte_callback
+
         self.play_audio_callback = play_audio_callback
 
         self.set_use_color_mode(False)
 
+        self.set_quirks("default")
+
         self.reset()
 
     def reset(self):
+        """
+        Returns the machine to its power-on state.
+
+        Every buffer was allocated once in __init__ and is cleared in place here, so
+        resetting or switching ROMs does not churn the heap.
+        """
 
         # Memory and registers
-        self.memory = bytearray(4096)
-        self.v = [0] * 16
+        memory = self.memory
+        for a in range(4096):
+            memory[a] = 0
+        v = self.v
+        stack = self.stack
+        keypad = self.keypad
+        key_timestamps = self.key_timestamps
+        for k in range(16):
+            v[k] = 0
+            stack[k] = 0
+            keypad[k] = False
+            key_timestamps[k] = 0
+        self.release_queue.clear()
+        self.key_wait = -1
+        self.input_queue.clear()
+        self.latency_pending.clear()
         self.i = 0
         self.pc = 0x200
+        self.cycles = 0
+        self.cycle_debt = 0
 
         # Stack and timers
-        self.stack = [0] * 16
         self.sp = 0
-        self.delay_timer = 0
-        self.sound_timer = 0
+        self.tick_base = 0
+        self.tick_base_cycle = 0
+        self.delay_deadline = 0
+        self.sound_deadline = 0
+        self.sound_started = False
+        audio_pattern = self.audio_pattern
+        for k in range(16):
+            audio_pattern[k] = 0
+        self.audio_pitch = 64
+        self.xo_audio = False
+        self.audio_changed = False
+        self.update_timers()
 
         # Display
-        self.screen = self.get_clear_screen_bytes()
-
-        # Keypad
-        self.keypad = [False] * 16
-        self.key_timestamps = [0] * 16
-        self.key_delay = 200  # key release delay in milliseconds
+        if self.hires:
+            self.set_resolution(False)
+        screen = self.screen
+        presented = self.presented
+        dirty_lo = self.dirty_lo
+        dirty_hi = self.dirty_hi
+        for y in range(64):
+            screen[y] = 0
+            presented[y] = 0
+            dirty_lo[y] = 0xFF
+            dirty_hi[y] = 0
+        self.redraw_all = True
 
         # Load fontset into memory
-        for i, char in enumerate(self.fontset):
-            self.memory[i + 0x50] = char
+        for i in range(len(self.fontset)):
+            memory[i + 0x50] = self.fontset[i]
+
+        # memory was cleared, so nothing decoded or compiled so far is valid
+        self.flush_decoded()
+        self.flush_blocks()
 
         self.display_dirty = False
 
+        self.unknown_opcode_count = 0
+        self.last_unknown_opcode = None
+
         self.next_cycle_run_time = time.ticks_ms()
 
         self.stop()
@@ -243,34 +549,77 @@ class Chip8:
         pass
 
     def key_press(self, key):
-        mapped_key = self.key_map[key]
-
-        self.keypad[mapped_key] = True
-        self.key_timestamps[mapped_key] = time.ticks_ms()
-
+        self.queue_key(self.key_map[key], True)
         pass
 
     def key_release(self, key):
-        mapped_key = self.key_map[key]
-
-        self.keypad[mapped_key] = False
+        self.queue_key(self.key_map[key], False)
         pass
 
+    def queue_key(self, key, pressed, cycle=None, timestamp=None):
+        """
+        Queues a change of Chip-8 key 0x0-0xF, applied when self.cycles reaches `cycle`.
+
+        By default the change applies at the current cycle, i.e. at the start of the
+        next batch. A later `cycle` is applied inside the batch that reaches it, at the
+        instruction boundary (the recompiler at the end of the block). `timestamp` is
+        the ticks_ms() of the host event, for latency tracking; it defaults to now.
+        Events must be queued in cycle order.
+        """
+
+        if timestamp is None:
+            timestamp = time.ticks_ms()
+        if cycle is None:
+            cycle = self.cycles
+        self.input_queue.append((cycle, key, pressed, timestamp))
+
+        if pressed and self.auto_release:
+            self.key_timestamps[key] = timestamp
+            heapq.heappush(self.release_queue, (ticks_add(timestamp, self.key_delay), key))
+
+    def set_key(self, key, pressed):
+        """
+        Sets Chip-8 key 0x0-0xF, logging the change while input is being recorded.
+
+        A press resumes a CPU halted in FX0A, with the key loaded into its register.
+        """
+
+        if self.keypad[key] == pressed:
+            return
+        self.keypad[key] = pressed
+
+        if self.input_log is not None:
+            # (cycle, key, down) packed into one int, see chip8_replay
+            self.input_log.append((self.cycles << 5) | (key << 1) | (1 if pressed else 0))
+
+        if pressed and self.key_wait >= 0:
+            self.v[self.key_wait] = key
+            self.key_wait = -1
+            self.pc += 2
+
     def check_keypress_timestamps(self):
+        """Releases auto-released keys whose key_delay has run out."""
+
+        queue = self.release_queue
+        if not queue:
+            return
         current_time = time.ticks_ms()
-        for i in range(16):
-            if (
-                self.keypad[i]
-                and current_time - self.key_timestamps[i] >= self.key_delay
-            ):
-                self.keypad[i] = False
-        pass
+        while queue and ticks_diff(current_time, queue[0][0]) >= 0:
+            release_time, key = heapq.heappop(queue)
+            # a later press of the same key queued its own, later release
+            if ticks_diff(current_time, self.key_timestamps[key]) >= self.key_delay:
+                self.queue_key(key, False, None, current_time)
+
+    def seed(self, value):
+        """Seeds the random number generator used by CXNN so runs can be reproduced."""
+        self.rng_state = (value & 0xFFFF) or 0xACE1
 
     def load_rom(self, rom):
-        print(f"Loading ROM")
-        for i, byte in enumerate(rom, start=0x200):
-            # print(f"byte: {byte}")
-            self.memory[i] = byte
+        if len(rom) > 4096 - 0x200:
+            raise ValueError("ROM is %d bytes, at most %d fit" % (len(rom), 4096 - 0x200))
+        # one slice copy rather than a byte-by-byte loop
+        self.memory[0x200 : 0x200 + len(rom)] = rom
+        self.invalidate_code(0x200, len(rom))
 
     def load_external_program(self, filename):
         """Loads a Chip-8 ROM file into the emulator's memory."""
@@ -282,446 +631,1565 @@ class Chip8:
         self.load_rom(rom_data)
         self.start()
 
+    def save_state(self, buf=None):
+        """
+        Serializes the machine into a versioned STATE_SIZE byte blob and returns it.
+
+        Pass a preallocated bytearray(STATE_SIZE) as `buf` to snapshot without
+        allocating a new buffer every time.
+        """
+
+        if buf is None:
+            buf = bytearray(STATE_SIZE)
+
+        buf[0:2] = STATE_MAGIC
+        buf[2] = STATE_VERSION
+        buf[3] = 0
+
+        buf[STATE_MEMORY : STATE_MEMORY + 4096] = self.memory
+
+        v = self.v
+        stack = self.stack
+        keypad = self.keypad
+        for k in range(16):
+            buf[STATE_V + k] = v[k]
+            buf[STATE_STACK + k * 2] = stack[k] >> 8
+            buf[STATE_STACK + k * 2 + 1] = stack[k] & 0xFF
+            buf[STATE_KEYPAD + k] = 1 if keypad[k] else 0
+
+        buf[STATE_I] = self.i >> 8
+        buf[STATE_I + 1] = self.i & 0xFF
+        buf[STATE_PC] = self.pc >> 8
+        buf[STATE_PC + 1] = self.pc & 0xFF
+        buf[STATE_SP] = self.sp
+        buf[STATE_TIMERS] = self.delay_timer
+        buf[STATE_TIMERS + 1] = self.sound_timer
+        buf[STATE_MODE] = 1 if self.hires else 0
+        buf[STATE_AUDIO : STATE_AUDIO + 16] = self.audio_pattern
+        buf[STATE_AUDIO + 16] = self.audio_pitch
+        buf[STATE_AUDIO + 17] = 1 if self.xo_audio else 0
+        buf[STATE_RNG] = self.rng_state >> 8
+        buf[STATE_RNG + 1] = self.rng_state & 0xFF
+
+        screen = self.screen
+        for y in range(64):
+            offset = STATE_SCREEN + y * 16
+            buf[offset : offset + 16] = screen[y].to_bytes(16, "big")
+
+        return buf
+
+    def load_state(self, buf):
+        """
+        Restores a blob from save_state in place, without reallocating any buffers.
+
+        Raises ValueError if `buf` is not a state blob of this version. Cached code is
+        only dropped when memory actually differs from the snapshot, and only rows that
+        differ from the presented screen are redrawn.
+        """
+
+        if len(buf) != STATE_SIZE or buf[0:2] != STATE_MAGIC or buf[2] != STATE_VERSION:
+            raise ValueError("Not a Chip8 state (version %d)" % STATE_VERSION)
+
+        data = memoryview(buf)
+
+        saved_memory = data[STATE_MEMORY : STATE_MEMORY + 4096]
+        if self.memory != saved_memory:
+            self.memory[0:4096] = saved_memory
+            self.flush_decoded()
+            self.flush_blocks()
+
+        v = self.v
+        stack = self.stack
+        keypad = self.keypad
+        for k in range(16):
+            v[k] = buf[STATE_V + k]
+            stack[k] = (buf[STATE_STACK + k * 2] << 8) | buf[STATE_STACK + k * 2 + 1]
+            keypad[k] = buf[STATE_KEYPAD + k] == 1
+
+        self.i = (buf[STATE_I] << 8) | buf[STATE_I + 1]
+        self.pc = (buf[STATE_PC] << 8) | buf[STATE_PC + 1]
+        # a CPU halted in FX0A was saved with pc on the FX0A, which halts again when run
+        self.key_wait = -1
+        self.sp = buf[STATE_SP]
+        self.delay_timer = buf[STATE_TIMERS]
+        self.sound_timer = buf[STATE_TIMERS + 1]
+        self.sound_started = False
+        self.audio_pattern[0:16] = data[STATE_AUDIO : STATE_AUDIO + 16]
+        self.audio_pitch = buf[STATE_AUDIO + 16]
+        self.xo_audio = buf[STATE_AUDIO + 17] == 1
+        self.audio_changed = True
+        self.update_timers()
+        self.rng_state = (buf[STATE_RNG] << 8) | buf[STATE_RNG + 1]
+
+        hires = buf[STATE_MODE] == 1
+        if hires != self.hires:
+            self.set_resolution(hires)
+
+        screen = self.screen
+        presented = self.presented
+        top = self.columns - 1
+        for y in range(64):
+            offset = STATE_SCREEN + y * 16
+            line = int.from_bytes(data[offset : offset + 16], "big")
+            screen[y] = line
+            if line != presented[y]:
+                self.dirty_lo[y] = 0
+                self.dirty_hi[y] = top
+                self.display_dirty = True
+
 
     def set_use_color_mode(self, use_color_mode):
         self.use_color_mode = use_color_mode
 
-    def get_clear_screen_bytes(self):
-        return bytearray(self.width * self.height)
-
-    def start(self):
+    def clear_screen(self):
+        screen = self.screen
+        dirty_lo = self.dirty_lo
+        dirty_hi = self.dirty_hi
+        top = self.columns - 1
+        for y in range(self.rows):
+            if screen[y]:
+                screen[y] = 0
+                dirty_lo[y] = 0
+                dirty_hi[y] = top
+
+    def set_resolution(self, hires):
+        """
+        Switches between the 64x32 display and the SUPER-CHIP 128x64 one, clearing it.
+
+        The scale is recomputed for the host screen and every pixel is redrawn on the
+        next draw_screen; resolution_callback lets the frontend adjust first.
+        """
+
+        self.hires = hires
+        self.columns = 128 if hires else 64
+        self.rows = 64 if hires else 32
+        self.row_mask = (1 << self.columns) - 1
+        self.scale = min(self.width // self.columns, self.height // self.rows)
+
+        screen = self.screen
+        presented = self.presented
+        dirty_lo = self.dirty_lo
+        dirty_hi = self.dirty_hi
+        for y in range(64):
+            screen[y] = 0
+            presented[y] = 0
+            dirty_lo[y] = 0xFF
+            dirty_hi[y] = 0
+        self.redraw_all = True
+        self.display_dirty = True
 
-        self.running = True
-        self.next_cycle_run_time = time.ticks_ms() + self.clock_cycle_interval
-        pass
+        if self.resolution_callback:
+            self.resolution_callback(self.columns, self.rows)
 
-    def stop(self):
-        self.running = False
-        pass
+    def scroll_rows(self, count):
+        """Moves the display down `count` rows (up if negative) as one slice move."""
 
-    def handle_0x0000(self, opcode):
-        if opcode == 0x00E0:  # Clear screen
-            # self.screen.clear()
-            self.screen = self.get_clear_screen_bytes()
-            self.display_dirty = True
-        elif opcode == 0x00EE:  # Return from subroutine
-            self.sp -= 1
-            self.pc = self.stack[self.sp]
+        screen = self.screen
+        rows = self.rows
+        if count >= 0:
+            screen[count:rows] = screen[0 : rows - count]
+            for y in range(count):
+                screen[y] = 0
         else:
-            print(f"Unknown opcode: {hex(opcode)}")
-        pass
-
-    def handle_0x1000(self, opcode):
-        nnn = opcode & 0xFFF
-        self.pc = nnn
-        pass
-
-    def handle_0x2000(self, opcode):
-        nnn = opcode & 0xFFF
-        self.stack[self.sp] = self.pc
-        self.sp += 1
-        self.pc = nnn
-        pass
+            screen[0 : rows + count] = screen[-count:rows]
+            for y in range(rows + count, rows):
+                screen[y] = 0
+        self.mark_rows_dirty()
+
+    def scroll_columns(self, count):
+        """Moves the display right `count` pixels (left if negative), one shift per row."""
+
+        screen = self.screen
+        mask = self.row_mask
+        for y in range(self.rows):
+            line = screen[y]
+            if line:
+                if count >= 0:
+                    screen[y] = line >> count
+                else:
+                    screen[y] = (line << -count) & mask
+        self.mark_rows_dirty()
+
+    def mark_rows_dirty(self):
+        dirty_lo = self.dirty_lo
+        dirty_hi = self.dirty_hi
+        top = self.columns - 1
+        for y in range(self.rows):
+            dirty_lo[y] = 0
+            dirty_hi[y] = top
+        self.display_dirty = True
 
-    def handle_0x3000(self, opcode):
-        nn = opcode & 0x00FF
-        x = (opcode & 0x0F00) >> 8
-        vx = x
-        
-        # nn = nn
-        if self.v[vx] == nn:
-            self.pc += 2
-        pass
+    def invalidate_display(self):
+        """Makes the next draw_screen repaint every pixel, e.g. after the host cleared its display."""
+        self.redraw_all = True
+        self.display_dirty = True
 
-    def handle_0x4000(self, opcode):
-        nn = opcode & 0x00FF
-        x = (opcode & 0x0F00) >> 8
-        vx = x
-        
-        # nn = nn
-        if self.v[vx] != nn:
-            self.pc += 2
-        pass
+    def get_pixel(self, x, y):
+        """Returns 1 if the pixel at (x, y) is on, else 0."""
+        return (self.screen[y] >> (self.columns - 1 - x)) & 1
 
-    def handle_0x5000(self, opcode):
-        x = (opcode & 0x0F00) >> 8
-        y = (opcode & 0x00F0) >> 4
-        vx = x
-        vy = y
-        if self.v[vx] == self.v[vy]:
-            self.pc += 2
-        pass
+    def unpack_row(self, y, pixels=None):
+        """Unpacks row `y` into a bytearray of `columns` 0/1 values (reusing `pixels` if given)."""
 
-    def handle_0x6000(self, opcode):
-        nn = opcode & 0x00FF
-        x = (opcode & 0x0F00) >> 8
-        
-        vx = x
-        # nn = nn
-        self.v[vx] = nn
-        pass
+        columns = self.columns
+        if pixels is None:
+            pixels = bytearray(columns)
+        line = self.screen[y]
+        for x in range(columns):
+            pixels[x] = (line >> (columns - 1 - x)) & 1
+        return pixels
 
-    def handle_0x7000(self, opcode):
-        nn = opcode & 0x00FF
-        x = (opcode & 0x0F00) >> 8
-        vx = x
-        # nn = nn
-        self.v[vx] += nn
-        self.v[vx] &= 0xFF  # Carry flag
-        pass
+    def row_bytes(self, y):
+        """Returns row `y` as columns / 8 bytes, leftmost pixel in the high bit of the first byte."""
+        return self.screen[y].to_bytes(self.columns // 8, "big")
 
-    def handle_0x8000(self, opcode):
-        n = opcode & 0x000F
-        x = (opcode & 0x0F00) >> 8
-        y = (opcode & 0x00F0) >> 4
-
-        vx = x
-        vy = y
-        switch_case = n
-        if switch_case == 0x0:  # Set VX to VY
-            self.v[vx] = self.v[vy]
-        elif switch_case == 0x1:  # Set VX to VX OR VY
-            self.v[vx] |= self.v[vy]
-        elif switch_case == 0x2:  # Set VX to VX AND VY
-            self.v[vx] &= self.v[vy]
-        elif switch_case == 0x3:  # Set VX to VX XOR VY
-            self.v[vx] ^= self.v[vy]
-        elif switch_case == 0x4:  # Add VY to VX. VF is set to 1 if carry
-            self.v[vx] += self.v[vy]
-            self.v[0xF] = 1 if self.v[vx] > 0xFF else 0
-            self.v[vx] &= 0xFF
-        elif (
-            switch_case == 0x5
-        ):  # Subtract VY from VX. VF is set to 0 if borrow
-            self.v[0xF] = 1 if self.v[vx] > self.v[vy] else 0
-            self.v[vx] -= self.v[vy]
-            self.v[vx] &= 0xFF
-        elif (
-            switch_case == 0x6
-        ):  # Shift VX right by one. VF is set to the least significant bit of VX
-            self.v[0xF] = self.v[vx] & 0x1
-            self.v[vx] >>= 1
-        elif switch_case == 0x7:  # Set VX to VY - VX. VF is set to 0 if borrow
-            self.v[0xF] = 1 if self.v[vy] > self.v[vx] else 0
-            self.v[vx] = self.v[vy] - self.v[vx]
-            self.v[vx] &= 0xFF
-        elif (
-            switch_case == 0xE
-        ):  # Shift VX left by one. VF is set to the most significant bit of VX
-            self.v[0xF] = (self.v[vx] & 0x80) >> 7
-            self.v[vx] <<= 1
-            self.v[vx] &= 0xFF
-        else:
-            print(f"Unknown opcode: {hex(opcode)}")
-        pass
+    def screen_bytes(self):
+        """Returns the framebuffer row by row: 256 bytes, or 1024 in hi-res mode."""
 
-    def handle_0x9000(self, opcode):
-        x = (opcode & 0x0F00) >> 8
-        y = (opcode & 0x00F0) >> 4
+        width = self.columns // 8
+        data = bytearray(width * self.rows)
+        for y in range(self.rows):
+            data[y * width : y * width + width] = self.screen[y].to_bytes(width, "big")
+        return data
 
-        vx = x
-        vy = y
-        if self.v[vx] != self.v[vy]:
-            self.pc += 2
-        pass
+    def start(self):
 
-    def handle_0xA000(self, opcode):
-        nnn = opcode & 0xFFF
-        self.i = nnn
+        self.running = True
+        self.next_cycle_run_time = time.ticks_ms() + self.clock_cycle_interval
         pass
 
-    def handle_0xB000(self, opcode):
-        nnn = opcode & 0xFFF
-        self.pc = (nnn) + self.v[0]
+    def stop(self):
+        self.running = False
         pass
 
-    def handle_0xC000(self, opcode):
-        nn = opcode & 0x00FF
-        x = (opcode & 0x0F00) >> 8
+    # Instruction handlers.
+    #
+    # Each op_* method receives the operands pre-extracted by decode_opcode and returns
+    # an execute(pc) closure that runs the instruction and returns the next pc. The
+    # closures are what the decode cache stores, so the hot path never re-masks opcodes.
 
-        vx = x
-        # nn = nn
-        self.v[vx] = random.randint(0, 255) & nn
-        pass
-
-    def handle_0xD000(self, opcode):
-        x = (opcode & 0x0F00) >> 8
-        y = (opcode & 0x00F0) >> 4
-        n = opcode & 0x000F
-
-        # Draw sprite
-        vx = x
-        vy = y
-        height = n
-        self.v[0xF] = 0  # Clear VF register
-        for row in range(height):
-            sprite_byte = self.memory[self.i + row]
-
-            if self.experimental_optimization:
-                for col in range(0, 8, 2):
-                    pixel0 = (sprite_byte >> (7 - col)) & 1
-                    pixel1 = (sprite_byte >> (6 - col)) & 1
-                    screen_x = (self.v[vx] + col) % 64
-                    screen_y = self.v[vy] + row
-                    index0 = screen_y * 64 + screen_x
-                    index1 = screen_y * 64 + screen_x + 1
-                    if pixel0 and self.screen[index0]:
-                        self.v[0xF] = 1
-                    self.screen[index0] ^= pixel0
-                    if pixel1 and self.screen[index1]:
-                        self.v[0xF] = 1
-                    self.screen[index1] ^= pixel1
+    def op_00e0(self, a, b, c):  # Clear screen
+        clear_screen = self.clear_screen
+        def execute(pc):
+            clear_screen()
+            self.display_dirty = True
+            return pc + 2
+        return execute
 
+    def op_00ee(self, a, b, c):  # Return from subroutine
+        stack = self.stack
+        def execute(pc):
+            self.sp -= 1
+            return stack[self.sp]
+        return execute
+
+    def op_00cn(self, n, b, c):  # Scroll the display down N rows
+        scroll_rows = self.scroll_rows
+        def execute(pc):
+            scroll_rows(n)
+            return pc + 2
+        return execute
+
+    def op_00fb(self, a, b, c):  # Scroll the display right 4 pixels
+        scroll_columns = self.scroll_columns
+        def execute(pc):
+            scroll_columns(4)
+            return pc + 2
+        return execute
+
+    def op_00fc(self, a, b, c):  # Scroll the display left 4 pixels
+        scroll_columns = self.scroll_columns
+        def execute(pc):
+            scroll_columns(-4)
+            return pc + 2
+        return execute
+
+    def op_00fd(self, a, b, c):  # Exit the interpreter
+        def execute(pc):
+            self.stop()
+            return pc
+        return execute
+
+    def op_00fe(self, a, b, c):  # Switch to the 64x32 display
+        def execute(pc):
+            self.set_resolution(False)
+            return pc + 2
+        return execute
+
+    def op_00ff(self, a, b, c):  # Switch to the 128x64 SUPER-CHIP display
+        def execute(pc):
+            self.set_resolution(True)
+            return pc + 2
+        return execute
+
+    def op_1nnn(self, nnn, b, c):  # Jump to address NNN
+        def execute(pc):
+            return nnn
+        return execute
+
+    def op_2nnn(self, nnn, b, c):  # Call subroutine at NNN
+        stack = self.stack
+        def execute(pc):
+            stack[self.sp] = pc + 2
+            self.sp += 1
+            return nnn
+        return execute
+
+    def op_3xnn(self, x, nn, c):  # Skip next instruction if VX == NN
+        v = self.v
+        def execute(pc):
+            if v[x] == nn:
+                return pc + 4
+            return pc + 2
+        return execute
+
+    def op_4xnn(self, x, nn, c):  # Skip next instruction if VX != NN
+        v = self.v
+        def execute(pc):
+            if v[x] != nn:
+                return pc + 4
+            return pc + 2
+        return execute
+
+    def op_5xy0(self, x, y, c):  # Skip next instruction if VX == VY
+        v = self.v
+        def execute(pc):
+            if v[x] == v[y]:
+                return pc + 4
+            return pc + 2
+        return execute
+
+    def op_6xnn(self, x, nn, c):  # Set VX to NN
+        v = self.v
+        def execute(pc):
+            v[x] = nn
+            return pc + 2
+        return execute
+
+    def op_7xnn(self, x, nn, c):  # Add NN to VX (no carry flag)
+        v = self.v
+        def execute(pc):
+            v[x] = (v[x] + nn) & 0xFF
+            return pc + 2
+        return execute
+
+    def op_8xy0(self, x, y, c):  # Set VX to VY
+        v = self.v
+        def execute(pc):
+            v[x] = v[y]
+            return pc + 2
+        return execute
+
+    def op_8xy1(self, x, y, c):  # Set VX to VX OR VY
+        v = self.v
+        def execute(pc):
+            v[x] |= v[y]
+            return pc + 2
+        return execute
+
+    def op_8xy2(self, x, y, c):  # Set VX to VX AND VY
+        v = self.v
+        def execute(pc):
+            v[x] &= v[y]
+            return pc + 2
+        return execute
+
+    def op_8xy3(self, x, y, c):  # Set VX to VX XOR VY
+        v = self.v
+        def execute(pc):
+            v[x] ^= v[y]
+            return pc + 2
+        return execute
+
+    def op_8xy4(self, x, y, c):  # Add VY to VX. VF is set to 1 if carry
+        v = self.v
+        def execute(pc):
+            total = v[x] + v[y]
+            v[x] = total
+            v[0xF] = 1 if total > 0xFF else 0
+            v[x] &= 0xFF
+            return pc + 2
+        return execute
+
+    def op_8xy5(self, x, y, c):  # Subtract VY from VX. VF is set to 0 if borrow
+        v = self.v
+        def execute(pc):
+            v[0xF] = 1 if v[x] > v[y] else 0
+            v[x] = (v[x] - v[y]) & 0xFF
+            return pc + 2
+        return execute
+
+    def op_8xy6(self, x, y, c):  # Shift VX right by one. VF is set to the least significant bit of VX
+        v = self.v
+        def execute(pc):
+            v[0xF] = v[x] & 0x1
+            v[x] >>= 1
+            return pc + 2
+        return execute
+
+    def op_8xy7(self, x, y, c):  # Set VX to VY - VX. VF is set to 0 if borrow
+        v = self.v
+        def execute(pc):
+            v[0xF] = 1 if v[y] > v[x] else 0
+            v[x] = (v[y] - v[x]) & 0xFF
+            return pc + 2
+        return execute
+
+    def op_8xye(self, x, y, c):  # Shift VX left by one. VF is set to the most significant bit of VX
+        v = self.v
+        def execute(pc):
+            v[0xF] = (v[x] & 0x80) >> 7
+            v[x] = (v[x] << 1) & 0xFF
+            return pc + 2
+        return execute
+
+    def op_8xy6_vy(self, x, y, c):  # Set VX to VY shifted right by one (shift_vy quirk)
+        v = self.v
+        def execute(pc):
+            source = v[y]
+            v[x] = source >> 1
+            v[0xF] = source & 0x1
+            return pc + 2
+        return execute
+
+    def op_8xye_vy(self, x, y, c):  # Set VX to VY shifted left by one (shift_vy quirk)
+        v = self.v
+        def execute(pc):
+            source = v[y]
+            v[x] = (source << 1) & 0xFF
+            v[0xF] = source >> 7
+            return pc + 2
+        return execute
+
+    def op_9xy0(self, x, y, c):  # Skip next instruction if VX != VY
+        v = self.v
+        def execute(pc):
+            if v[x] != v[y]:
+                return pc + 4
+            return pc + 2
+        return execute
+
+    def op_annn(self, nnn, b, c):  # Set I to NNN
+        def execute(pc):
+            self.i = nnn
+            return pc + 2
+        return execute
+
+    def op_bnnn(self, nnn, b, c):  # Jump to address NNN + V0
+        v = self.v
+        def execute(pc):
+            return nnn + v[0]
+        return execute
+
+    def op_bxnn(self, nnn, b, c):  # Jump to address XNN + VX (jump_vx quirk)
+        v = self.v
+        x = nnn >> 8
+        def execute(pc):
+            return nnn + v[x]
+        return execute
+
+    def op_cxnn(self, x, nn, c):  # Set VX to a random number AND NN
+        v = self.v
+        def execute(pc):
+            # 16 bit xorshift, seeded by seed() so recorded runs replay identically
+            state = self.rng_state
+            state ^= (state << 7) & 0xFFFF
+            state ^= state >> 9
+            state ^= (state << 8) & 0xFFFF
+            self.rng_state = state
+            v[x] = state & nn
+            return pc + 2
+        return execute
+
+    def op_dxyn(self, x, y, n):  # Draw an 8xN sprite at (VX, VY)
+        draw_sprite = self.draw_sprite
+        def execute(pc):
+            draw_sprite(x, y, n)
+            return pc + 2
+        return execute
+
+    def op_ex9e(self, x, b, c):  # Skip next instruction if key with the value of VX is pressed
+        v = self.v
+        def execute(pc):
+            if self.keypad[v[x]]:
+                return pc + 4
+            return pc + 2
+        return execute
+
+    def op_exa1(self, x, b, c):  # Skip next instruction if key with the value of VX is not pressed
+        v = self.v
+        def execute(pc):
+            if not self.keypad[v[x]]:
+                return pc + 4
+            return pc + 2
+        return execute
+
+    def op_fx07(self, x, b, c):  # Set VX to delay timer value
+        v = self.v
+        def execute(pc):
+            v[x] = self.delay_timer
+            return pc + 2
+        return execute
+
+    def op_fx0a(self, x, b, c):  # Wait for a key press and store the value in VX
+        def execute(pc):
+            # halt on this instruction until set_key sees a press; the run loops skip
+            # their batches without executing anything until then
+            self.pc = pc
+            self.key_wait = x
+            raise self.idle_signal
+        return execute
+
+    def op_fx15(self, x, b, c):  # Set delay timer to VX
+        v = self.v
+        def execute(pc):
+            self.delay_timer = v[x]
+            return pc + 2
+        return execute
+
+    def op_fx18(self, x, b, c):  # Set sound timer to VX
+        v = self.v
+        def execute(pc):
+            self.sound_timer = v[x]
+            if v[x]:
+                self.sound_started = True
+            return pc + 2
+        return execute
+
+    def op_fx02(self, x, b, c):  # XO-CHIP: load the 16-byte audio pattern from I
+        memory = self.memory
+        pattern = self.audio_pattern
+        def execute(pc):
+            i = self.i
+            for k in range(16):
+                pattern[k] = memory[(i + k) & 0xFFF]
+            self.xo_audio = True
+            self.audio_changed = True
+            return pc + 2
+        return execute
+
+    def op_fx3a(self, x, b, c):  # XO-CHIP: set the audio pitch register to VX
+        v = self.v
+        def execute(pc):
+            self.audio_pitch = v[x]
+            self.xo_audio = True
+            self.audio_changed = True
+            return pc + 2
+        return execute
+
+    def op_fx1e(self, x, b, c):  # Add VX to I
+        v = self.v
+        def execute(pc):
+            self.i = (self.i + v[x]) & 0xFFFF
+            return pc + 2
+        return execute
+
+    def op_fx29(self, x, b, c):  # Set I to the location of the sprite for the character in VX
+        v = self.v
+        def execute(pc):
+            self.i = v[x] * 5 + 0x50
+            return pc + 2
+        return execute
+
+    def op_fx33(self, x, b, c):  # Store the BCD representation of VX in I, I+1, and I+2
+        v = self.v
+        memory = self.memory
+        invalidate_code = self.invalidate_code
+        def execute(pc):
+            digit = v[x]
+            i = self.i
+            memory[i] = digit // 100
+            memory[i + 1] = (digit % 100) // 10
+            memory[i + 2] = digit % 10
+            invalidate_code(i, 3)
+            return pc + 2
+        return execute
+
+    def op_fx55(self, x, b, c):  # Store registers V0 to VX in memory starting at location I
+        v = self.v
+        memory = self.memory
+        invalidate_code = self.invalidate_code
+        def execute(pc):
+            i = self.i
+            for offset in range(x + 1):
+                memory[i + offset] = v[offset]
+            invalidate_code(i, x + 1)
+            self.i = i + x + 1
+            return pc + 2
+        return execute
+
+    def op_fx65(self, x, b, c):  # Read registers V0 to VX from memory starting at location I
+        v = self.v
+        memory = self.memory
+        def execute(pc):
+            i = self.i
+            for offset in range(x + 1):
+                v[offset] = memory[i + offset]
+            self.i = i + x + 1
+            return pc + 2
+        return execute
+
+    def op_fx55_keep_i(self, x, b, c):  # Store V0 to VX at I, leaving I unchanged
+        v = self.v
+        memory = self.memory
+        invalidate_code = self.invalidate_code
+        def execute(pc):
+            i = self.i
+            for offset in range(x + 1):
+                memory[i + offset] = v[offset]
+            invalidate_code(i, x + 1)
+            return pc + 2
+        return execute
+
+    def op_fx65_keep_i(self, x, b, c):  # Read V0 to VX from I, leaving I unchanged
+        v = self.v
+        memory = self.memory
+        def execute(pc):
+            i = self.i
+            for offset in range(x + 1):
+                v[offset] = memory[i + offset]
+            return pc + 2
+        return execute
+
+    def op_unknown(self, opcode, b, c):
+        def execute(pc):
+            # recorded rather than printed, formatting a message would allocate mid-frame
+            self.unknown_opcode_count += 1
+            self.last_unknown_opcode = opcode
+            return pc + 2
+        return execute
+
+    def op_idle(self, nnn, b, c):  # 1NNN closing an idle loop, see is_idle_loop
+        signal = self.idle_signal
+        def execute(pc):
+            self.pc = nnn
+            raise signal
+        return execute
+
+    def sprite_drawer(self, clip_columns, wrap_rows):
+        """
+        Returns a draw_sprite(x, y, n) for the given sprite quirks; set_quirks installs it.
+
+        draw_sprite XORs the N-byte sprite at I onto the screen at (VX, VY) and sets VF
+        on collision. Each sprite row is shifted into place as a row-wide mask, so a row
+        costs one AND for the collision test and one XOR. Pixels past the right edge
+        wrap around to the left, or are clipped with clip_columns; rows past the bottom
+        are clipped, or wrap around to the top with wrap_rows. The quirks are baked into
+        the function, so drawing never tests them. In hi-res mode DXY0 draws a 16x16
+        sprite stored as two bytes per row.
+        """
+
+        v = self.v
+        memory = self.memory
+        dirty_lo = self.dirty_lo
+        dirty_hi = self.dirty_hi
+
+        # ANDed with the row mask: all of the part past the right edge comes back in on
+        # the left when wrapping, none of it when clipping
+        wrap_mask = 0 if clip_columns else -1
+        # extra rows a sprite may run past the bottom edge, 0 to clip them
+        extra_rows = 16 if wrap_rows else 0
+
+        def draw_sprite(x, y, n):
+            screen = self.screen
+            address = self.i
+
+            columns = self.columns
+            rows = self.rows
+            if n == 0 and self.hires:
+                width = 16
+                n = 16
+            else:
+                width = 8
+
+            # a sprite row at column 0 sits in the top bits of the screen row
+            screen_x = v[x] & (columns - 1)
+            shift = columns - width - screen_x
+            screen_y = v[y] & (rows - 1)
+            carry = self.row_mask & wrap_mask
+
+            last = rows - screen_y + extra_rows
+            if n > last:
+                n = last
+
+            # columns the sprite can touch, for dirty tracking; across the right edge
+            # that is the rest of the row, or the whole row when wrapping
+            if shift >= 0:
+                span_lo = screen_x
+                span_hi = screen_x + width - 1
             else:
-                for col in range(8):
-                    # pixel = (sprite_byte & (0x80 >> col)) != 0
-                    pixel = (sprite_byte >> (7 - col)) & 1
-                    screen_x = (self.v[vx] + col) % 64
-                    screen_y = (self.v[vy] + row) % 32
-                    index = screen_y * 64 + screen_x
+                span_lo = screen_x & ~wrap_mask
+                span_hi = columns - 1
+
+            collision = 0
+            for row in range(n):
+                if screen_y == rows:
+                    screen_y = 0
+
+                if width == 8:
+                    sprite_row = memory[address]
+                    address += 1
+                else:
+                    sprite_row = (memory[address] << 8) | memory[address + 1]
+                    address += 2
+
+                if shift >= 0:
+                    bits = sprite_row << shift
+                else:
+                    bits = (sprite_row >> -shift) | ((sprite_row << (columns + shift)) & carry)
+
+                if bits:
+                    line = screen[screen_y]
+                    if line & bits:
+                        collision = 1
+                    screen[screen_y] = line ^ bits
+
+                    if dirty_lo[screen_y] > span_lo:
+                        dirty_lo[screen_y] = span_lo
+                    if dirty_hi[screen_y] < span_hi:
+                        dirty_hi[screen_y] = span_hi
+
+                screen_y += 1
+
+            v[0xF] = collision
+            self.display_dirty = True
 
-                    # Check for collision before XOR
-                    if pixel and self.screen[index]:
-                        self.v[0xF] = 1
+        return draw_sprite
 
-                    # apply XOR to all pixels in the sprite's bounding box
-                    self.screen[index] ^= pixel
+    def fetch_opcode(self):
+        return (self.memory[self.pc] << 8) | self.memory[self.pc + 1]
 
-                pass
+    def decode_opcode(self, opcode):
+        """
+        Splits an opcode into a (handler name, a, b, c) tuple.
 
-        self.display_dirty = True
-        pass
+        The operands are pre-extracted for the handler: (x, y, n), (x, nn, 0) or
+        (nnn, 0, 0) depending on the instruction.
+        """
 
-    def handle_0xE000(self, opcode):
-        nn = opcode & 0x00FF
-        x = (opcode & 0x0F00) >> 8
-        
-        vx = x
-        if (
-            nn == 0x009E
-        ):  # Skip next instruction if key with the value of VX is pressed
-            key = self.v[vx]
-            if self.keypad[key]:
-                self.pc += 2
-        elif (
-            nn == 0x00A1
-        ):  # Skip next instruction if key with the value of VX is not pressed
-            key = self.v[vx]
-            if not self.keypad[key]:
-                self.pc += 2
-        pass
+        family = opcode >> 12
+        x = (opcode >> 8) & 0xF
+        y = (opcode >> 4) & 0xF
+        n = opcode & 0xF
+        nn = opcode & 0xFF
+        nnn = opcode & 0xFFF
 
-    def handle_0xF000(self, opcode):
-        nn = opcode & 0x00FF
-        x = (opcode & 0x0F00) >> 8
-
-        vx = x
-        if nn == 0x0007:  # Set VX to delay timer value
-            self.v[vx] = self.delay_timer
-        elif (
-            nn == 0x000A
-        ):  # Wait for a key press and store the value in VX
-            # Implement key press handling
-            pass
-        elif nn == 0x0015:  # Set delay timer to VX
-            self.delay_timer = self.v[vx]
-        elif nn == 0x0018:  # Set sound timer to VX
-            self.sound_timer = self.v[vx]
-        elif nn == 0x001E:  # Add VX to I
-            self.i += self.v[vx]
-            self.i &= 0xFFFF
-        elif (
-            nn == 0x0029
-        ):  # Set I to the location of the sprite for the character in VX
-            # Implement sprite lookup
-            self.i = self.v[vx] * 5 + 0x50
-            pass
-        elif (
-            nn == 0x0033
-        ):  # Store the binary-coded decimal representation of VX in I, I+1, and I+2
-            # Implement BCD conversion
-            digit = self.v[vx]
-            self.memory[self.i] = digit // 100
-            self.memory[self.i + 1] = (digit % 100) // 10
-            self.memory[self.i + 2] = digit % 10
-            pass
-        elif (
-            nn == 0x0055
-        ):  # Store registers V0 to VX in memory starting at location I
-            for i in range(vx + 1):
-                self.memory[self.i + i] = self.v[i]
-            self.i += vx + 1
-        elif (
-            nn == 0x0065
-        ):  # Read registers V0 to VX from memory starting at location I
-            for i in range(vx + 1):
-                self.v[i] = self.memory[self.i + i]
-            self.i += vx + 1
+        if family == 0x0:
+            if opcode == 0x00E0:
+                return ("00e0", 0, 0, 0)
+            elif opcode == 0x00EE:
+                return ("00ee", 0, 0, 0)
+            elif opcode & 0xFFF0 == 0x00C0:
+                return ("00cn", n, 0, 0)
+            elif opcode in (0x00FB, 0x00FC, 0x00FD, 0x00FE, 0x00FF):
+                return ("00%02x" % nn, 0, 0, 0)
+        elif family == 0x1:
+            return ("1nnn", nnn, 0, 0)
+        elif family == 0x2:
+            return ("2nnn", nnn, 0, 0)
+        elif family == 0x3:
+            return ("3xnn", x, nn, 0)
+        elif family == 0x4:
+            return ("4xnn", x, nn, 0)
+        elif family == 0x5:
+            return ("5xy0", x, y, 0)
+        elif family == 0x6:
+            return ("6xnn", x, nn, 0)
+        elif family == 0x7:
+            return ("7xnn", x, nn, 0)
+        elif family == 0x8:
+            key = "8xy%x" % n
+            if key in self.handlers:
+                return (key, x, y, n)
+        elif family == 0x9:
+            return ("9xy0", x, y, 0)
+        elif family == 0xA:
+            return ("annn", nnn, 0, 0)
+        elif family == 0xB:
+            return ("bnnn", nnn, 0, 0)
+        elif family == 0xC:
+            return ("cxnn", x, nn, 0)
+        elif family == 0xD:
+            return ("dxyn", x, y, n)
+        elif family == 0xE:
+            key = "ex%02x" % nn
+            if key in self.handlers:
+                return (key, x, 0, 0)
         else:
-            print(f"Unknown opcode: {hex(opcode)}")
-        pass
-
+            key = "fx%02x" % nn
+            if key in self.handlers:
+                return (key, x, 0, 0)
+
+        return ("unknown", opcode, 0, 0)
+
+    def decode(self, address):
+        """Decodes the instruction at `address` and stores it in the decode cache."""
+
+        memory = self.memory
+        key, a, b, c = self.decode_opcode((memory[address] << 8) | memory[address + 1])
+        if key == "1nnn" and self.idle_detection and self.is_idle_loop(address, a):
+            key = "idle"
+        entry = self.handlers[key](a, b, c)
+        self.decoded[address] = entry
+        return entry
+
+    def is_idle_loop(self, address, target):
+        """
+        Tells whether the jump at `address` to `target` spins until the next timer tick.
+
+        Two patterns qualify: a jump to itself, and the delay timer poll
+
+            target:     FX07        VX = delay timer
+                        3XNN/4XNN   leave the loop once VX is (or is no longer) NN
+            address:    1target
+
+        Reaching the jump in the poll means the skip did not fire, and VX cannot change
+        before the delay timer does, so every further pass would do exactly the same.
+        """
+
+        if target == address:
+            return True
+
+        if target != address - 4:
+            return False
+
+        memory = self.memory
+        load = (memory[target] << 8) | memory[target + 1]
+        test = (memory[target + 2] << 8) | memory[target + 3]
+        x = (load >> 8) & 0xF
+        return (
+            load & 0xF0FF == 0xF007
+            and test >> 12 in (0x3, 0x4)
+            and (test >> 8) & 0xF == x
+        )
+
+    def invalidate_code(self, address, length):
+        """
+        Drops cached decodes overlapping memory[address:address + length].
+
+        Must be called after anything writes to memory so self-modifying ROMs stay correct.
+        An instruction starting one byte before `address` also overlaps the write, and
+        so does an idle loop jump up to four bytes after it (see is_idle_loop).
+        """
+
+        decoded = self.decoded
+        block_map = self.block_map
+        hits_block = False
+        for a in range(max(address - 1, 0), min(address + length + 4, 4096)):
+            decoded[a] = None
+        for a in range(max(address - 1, 0), min(address + length, 4096)):
+            if block_map[a]:
+                hits_block = True
+
+        if hits_block:
+            self.flush_blocks()
+
+    def flush_decoded(self):
+        decoded = self.decoded
+        for a in range(4096):
+            decoded[a] = None
+
+    def set_profiling(self, enabled):
+        """
+        Turns the per-instruction profiler on or off.
+
+        Profiling swaps every handler factory for one whose closures also count
+        executions, time spent and the pc they ran at, then drops the decode cache so
+        it refills with the instrumented closures. Turning it off swaps the plain
+        handlers back, so a disabled profiler costs nothing. Compiled blocks bypass the
+        handlers, so run_cycles uses the interpreter while profiling.
+        """
+
+        if enabled == (self.profile is not None):
+            return
+
+        if enabled:
+            if hasattr(time, "ticks_us"):
+                clock = time.ticks_us
+                elapsed = time.ticks_diff
+                clock_scale = 1
+            else:
+                clock = time.perf_counter_ns
+                elapsed = lambda end, start: end - start
+                clock_scale = 1000
+
+            self.profile = {}
+            self.profile_clock_scale = clock_scale
+            self.pc_histogram = array.array("L", [0] * 4096)
+            histogram = self.pc_histogram
+
+            def instrument(key, factory):
+                stats = [0, 0]  # executions, clock ticks
+                self.profile[key] = stats
+
+                def make(a, b, c):
+                    execute = factory(a, b, c)
+
+                    def profiled(pc):
+                        started = clock()
+                        try:
+                            return execute(pc)
+                        finally:
+                            # also when an idle loop or FX0A ends the batch with CpuIdle
+                            stats[1] += elapsed(clock(), started)
+                            stats[0] += 1
+                            histogram[pc] += 1
+
+                    return profiled
+
+                return make
+
+            self.plain_handlers = self.handlers
+            self.handlers = dict(
+                (key, instrument(key, factory)) for key, factory in self.plain_handlers.items()
+            )
+        else:
+            self.handlers = self.plain_handlers
+            self.profile = None
+
+        self.flush_decoded()
+        self.flush_blocks()
+
+    def profile_snapshot(self, hot_pcs=16):
+        """
+        Returns the profile gathered since set_profiling(True), or None if it is off.
+
+        "ops" has {"count", "time_us"} per instruction (e.g. "8xy4", "fx33"),
+        "families" the same summed per high nibble, "hot_pcs" the `hot_pcs` most
+        executed addresses as (address, count) pairs and "pc_histogram" a copy of the
+        4096-entry execution count per address.
+        """
+
+        if self.profile is None:
+            return None
+
+        scale = self.profile_clock_scale
+        ops = {}
+        families = {}
+        total = 0
+        for key, (count, ticks) in self.profile.items():
+            if not count:
+                continue
+            total += count
+            ops[key] = {"count": count, "time_us": ticks / scale}
+            if key == "unknown":
+                family = "?"
+            elif key == "idle":
+                # an idle-loop 1NNN (see is_idle_loop)
+                family = "1"
+            else:
+                family = key[0].upper()
+            summary = families.setdefault(family, {"count": 0, "time_us": 0})
+            summary["count"] += count
+            summary["time_us"] += ticks / scale
+
+        histogram = self.pc_histogram
+        hottest = sorted(
+            ((address, histogram[address]) for address in range(4096) if histogram[address]),
+            key=lambda item: -item[1],
+        )
+
+        return {
+            "instructions": total,
+            "ops": ops,
+            "families": families,
+            "hot_pcs": hottest[:hot_pcs],
+            "pc_histogram": array.array("L", histogram),
+        }
 
+    def set_engine(self, engine):
+        """Selects the execution engine used by run_cycles: "interpreter" or "recompiler"."""
+
+        if engine not in ("interpreter", "recompiler"):
+            raise ValueError("Unknown engine: %s" % engine)
+        self.engine = engine
+
+    def set_idle_detection(self, enabled):
+        """Turns idle loop detection on or off, dropping code cached under the old setting."""
+
+        self.idle_detection = enabled
+        self.flush_decoded()
+        self.flush_blocks()
+
+    def set_quirks(self, quirks="default"):
+        """
+        Selects how variant-specific instructions behave.
+
+        `quirks` is a profile name from QUIRK_PROFILES or a dict of quirk flags, with
+        missing flags taken from "default". The flags are resolved here, once, into the
+        handler table, the recompiler source and the sprite drawer, so running an
+        instruction never tests them. Cached code is dropped.
+        """
+
+        if isinstance(quirks, str):
+            if quirks not in QUIRK_PROFILES:
+                raise ValueError("Unknown quirk profile: %s" % quirks)
+            quirks = QUIRK_PROFILES[quirks]
+
+        resolved = dict(QUIRK_PROFILES["default"])
+        for name in quirks:
+            if name not in resolved:
+                raise ValueError("Unknown quirk: %s" % name)
+            resolved[name] = quirks[name]
+
+        # the profiler wraps whatever handlers are installed, so rebuild it afterwards
+        profiling = self.profile is not None
+        if profiling:
+            self.set_profiling(False)
+
+        self.quirks = resolved
+        for quirk, key, plain, variant in self.quirk_variants:
+            enabled = resolved[quirk]
+            self.handlers[key] = variant if enabled else plain
+            if key in self.quirk_block_code:
+                table = self.block_code if key in self.block_code else self.block_exit_code
+                table[key] = self.quirk_block_code[key] if enabled else self.plain_block_code[key]
+
+        # both sprite quirks shape DXYN, so its drawer is built here rather than picked
+        # from quirk_variants; op_dxyn and compiled blocks bind it as the caches refill
+        self.draw_sprite = self.sprite_drawer(resolved["clip_columns"], resolved["wrap_rows"])
+
+        self.flush_decoded()
+        self.flush_blocks()
+
+        if profiling:
+            self.set_profiling(True)
+
+    def compile_block(self, address):
+        """
+        Translates the basic block starting at `address` into a Python function.
+
+        A block is a run of straight-line instructions (see block_code) ended by a jump,
+        skip, call, return or sprite draw. The resulting execute(pc) function is cached
+        in self.blocks and its instruction count in self.block_lengths. If the first
+        instruction cannot be translated the interpreter's closure is cached instead, so
+        every address reached has exactly one entry. An idle loop jump is left to the
+        interpreter's op_idle so it can end the batch.
+        """
+
+        memory = self.memory
+        block_code = self.block_code
+        block_exit_code = self.block_exit_code
+
+        lines = []
+        pc = address
+        length = 0
+        falls_through = True
+        idle_jump = False
+
+        while length < self.max_block_length and pc < 4095:
+            key, a, b, c = self.decode_opcode((memory[pc] << 8) | memory[pc + 1])
+            operands = {"a": a, "b": b, "c": c, "pc": pc}
+
+            if key == "1nnn" and self.idle_detection and self.is_idle_loop(pc, a):
+                idle_jump = length == 0
+                break
+            elif key in block_code:
+                for line in block_code[key]:
+                    lines.append(line % operands)
+            elif key in block_exit_code:
+                for line in block_exit_code[key]:
+                    lines.append(line % operands)
+                falls_through = False
+            else:
+                break
 
-    def handle_unknown_opcode(self, opcode):
-        pass
+            pc += 2
+            length += 1
 
-    def fetch_opcode(self):
-        return (self.memory[self.pc] << 8) | self.memory[self.pc + 1]
+            if not falls_through:
+                break
 
-    def decode_opcode(self):
-        pass
+        if length == 0:
+            execute = self.decoded[address]
+            if execute is None:
+                execute = self.decode(address)
+            block = execute
+            length = 1
+        else:
+            if falls_through:
+                lines.append("return %d" % pc)
+
+            source = (
+                "def make_block(self, v, stack, draw_sprite):\n"
+                "    def block(pc):\n"
+                "        " + "\n        ".join(lines) + "\n"
+                "    return block\n"
+            )
+
+            make_block = self.block_factories.get(source)
+            if make_block is None:
+                namespace = {}
+                exec(source, namespace)
+                make_block = namespace["make_block"]
+                self.block_factories[source] = make_block
+
+            block = make_block(self, self.v, self.stack, self.draw_sprite)
+
+        # remember which bytes the block was built from so writes can invalidate it; an
+        # idle jump also depends on the poll loop in front of it
+        block_map = self.block_map
+        first = max(address - 4, 0) if idle_jump else address
+        for a in range(first, min(address + length * 2, 4096)):
+            block_map[a] = 1
+
+        self.blocks[address] = block
+        self.block_lengths[address] = length
+        self.block_starts.append(address)
+
+        return block
+
+    def flush_blocks(self):
+        """Drops every compiled block, in place so running loops see the change."""
+
+        blocks = self.blocks
+        block_map = self.block_map
+        block_lengths = self.block_lengths
+        for address in self.block_starts:
+            blocks[address] = None
+            for a in range(max(address - 4, 0), min(address + block_lengths[address] * 2, 4096)):
+                block_map[a] = 0
+
+        self.block_starts.clear()
+
+    def run_blocks(self, count):
+        """
+        Runs compiled basic blocks for a batch of `count` instructions.
+
+        Blocks are never split, so a batch may run up to max_block_length - 1
+        instructions past its budget. The overshoot is kept in cycle_debt and taken off
+        the next batch, so over time the recompiler runs exactly as many instructions as
+        the interpreter. Returns the number of instructions executed.
+        """
+
+        budget = count - self.cycle_debt
+        if budget <= 0:
+            # the last batch already ran this one
+            self.cycle_debt = -budget
+            return 0
+
+        blocks = self.blocks
+        block_lengths = self.block_lengths
+        compile_block = self.compile_block
+        pc = self.pc
+        executed = 0
+        self.idle = False
+
+        try:
+            while executed < budget:
+                block = blocks[pc]
+                if block is None:
+                    block = compile_block(pc)
+                length = block_lengths[pc]
+                pc = block(pc)
+                executed += length
+        except CpuIdle as signal:
+            signal.release()
+            # idle: the rest of the budget counts as run, as in run_cycles
+            pc = self.pc
+            executed = budget
+            self.idle = True
+
+        self.pc = pc
+        self.cycles += executed
+        self.cycle_debt = executed - budget
+
+        return executed
 
     def cycle(self):
 
         if self.running:
 
-            self.check_keypress_timestamps()
-
-            # Fetch opcode
-            opcode = self.fetch_opcode()
-            self.pc += 2
-
-            # Decode and execute opcode
-            # x = (opcode & 0x0F00) >> 8
-            # y = (opcode & 0x00F0) >> 4
-
-            # Hex nibble
-            # n = opcode & 0x000F
-
-            # Hex byte
-            # nn = opcode & 0x00FF
-
-            # Hex memory address
-            # nnn = opcode & 0xFFF
-
-            masked_opcode = opcode & 0xF000
-
-            # opcode_index = opcode >> 12  # Assuming 4 bits for opcode type
-
-            # handler = self.opcode_handlers.get(opcode_index, lambda opcode: print(f"Unknown opcode: {hex(opcode)}"))
-            handler = self.opcode_handlers.get(masked_opcode, lambda opcode: print(f"Unknown opcode: {hex(opcode)}"))
-            handler(opcode)
-
-            # # if masked_opcode == 0x0000:
-            # if opcode_index == 0:
-            #     self.handle_0x0000(opcode)
-            #     pass
-            # # elif masked_opcode == 0x1000:  # Jump to address nnn
-            # elif opcode_index == 1:
-            #     self.handle_0x1000(opcode)
-            #     pass
-            # # elif masked_opcode == 0x2000:  # Call subroutine
-            # elif opcode_index == 2:
-            #     self.handle_0x2000(opcode)
-            # # elif masked_opcode == 0x3000:  # Skip next instruction if VX == NN
-            # elif opcode_index == 3:
-            #     self.handle_0x3000(opcode)
-            # # elif masked_opcode == 0x4000:  # Skip next instruction if VX != NN
-            # elif opcode_index == 4:
-            #     self.handle_0x4000(opcode)
-            # # elif masked_opcode == 0x5000:  # Skip next instruction if VX == VY
-            # elif opcode_index == 5:
-            #     self.handle_0x5000(opcode)
-            # # elif masked_opcode == 0x6000:  # Set VX to NN
-            # elif opcode_index == 6:
-            #     self.handle_0x6000(opcode)
-
-                
-            # # elif masked_opcode == 0x7000:  # Add NN to VX
-            # elif opcode_index == 7:
-            #     self.handle_0x7000(opcode)
-
-                
-            # # elif masked_opcode == 0x8000:  # Mathematical and logical operations
-            # elif opcode_index == 8:
-            #     self.handle_0x8000(opcode)
-
-                
-            # # elif masked_opcode == 0x9000:  # Skip next instruction if VX != VY
-            # elif opcode_index == 9:
-            #     self.handle_0x9000(opcode)
-
-                
-            # # elif masked_opcode == 0xA000:  # Set I to nnn
-            # elif opcode_index == 10:
-            #     self.handle_0xA000(opcode)
-
-                
-            # # elif masked_opcode == 0xB000:  # Jump to address nnn + V0
-            # elif opcode_index == 11:
-            #     self.handle_0xB000(opcode)
-
-                
-            # # elif masked_opcode == 0xC000:  # Set VX to random number AND NN
-            # elif opcode_index == 12:
-            #     self.handle_0xC000(opcode)
-
-                
-            # # elif masked_opcode == 0xD000:
-            # elif opcode_index == 13:
-            #     self.handle_0xD000(opcode)
-
-                
-
-            # # elif masked_opcode == 0xE000:
-            # elif opcode_index == 14:
-            #     self.handle_0xE000(opcode)
-
-                
-            # # elif masked_opcode == 0xF000:
-            # elif opcode_index == 15:
-            #     self.handle_0xF000(opcode)
-
-
-            # Update timers
-            if self.delay_timer > 0:
-                self.delay_timer -= 1
-
-            if self.sound_timer > 0:
-
-                if not self.is_sound_playing:
-                    self.is_sound_playing = True
-                    if self.play_audio_callback:
-                        self.play_audio_callback(self.is_sound_playing)
-
-                self.sound_timer -= 1
-
-                if self.sound_timer == 0:
-                    self.is_sound_playing = False
-                    self.play_audio_callback(self.is_sound_playing)
+            if self.release_queue:
+                self.check_keypress_timestamps()
+            if self.input_queue:
+                self.apply_input(self.input_queue)
 
+            if self.key_wait >= 0:
+                # halted in FX0A until a key is pressed
+                self.idle = True
             else:
-                # stop the sound
-                # self.play_audio_callback(False)
-                pass
+                # Fetch and decode (cached per address), then execute
+                entry = self.decoded[self.pc]
+                if entry is None:
+                    entry = self.decode(self.pc)
+                try:
+                    self.pc = entry(self.pc)
+                    self.idle = False
+                except CpuIdle as signal:
+                    signal.release()
+                    self.idle = True
+            self.cycles += 1
+
+            # Start or stop the sound if its timer ran out
+            self.update_timers()
 
             if self.display_dirty:
                 self.draw_screen()
                 self.display_dirty = False
+                if self.latency_pending:
+                    self.record_latency()
+
+    def run_cycles(self, count):
+        """
+        Executes `count` instructions in a tight loop and returns how many ran.
+
+        Timers, key release and drawing are not touched here; run_frame takes care of
+        those once per batch so the frontend only has to present once. The recompiler
+        finishes the block it is in, so a single batch may run slightly more or less than
+        `count`, but the difference is made up in the next one (see run_blocks).
+
+        If the program enters an idle loop the batch ends there and self.idle is set; the
+        skipped iterations still count towards the instructions returned and self.cycles,
+        so timing stays the same as spinning through them. The same goes for FX0A: while
+        it waits for a key, whole batches are counted without executing anything.
+
+        Key events queued with queue_key are applied at their cycle, so a batch with
+        input pending is run in pieces split at those cycles.
+        """
+
+        if not self.running:
+            return 0
+
+        if self.input_queue:
+            return self.run_queued_input(count)
+
+        if self.key_wait >= 0:
+            self.idle = True
+            self.cycles += count
+            return count
+
+        if self.engine == "recompiler" and self.profile is None:
+            return self.run_blocks(count)
+
+        decoded = self.decoded
+        decode = self.decode
+        pc = self.pc
+        self.idle = False
+
+        try:
+            for _ in range(count):
+                entry = decoded[pc]
+                if entry is None:
+                    entry = decode(pc)
+                pc = entry(pc)
+        except CpuIdle as signal:
+            signal.release()
+            # an idle loop would only spin for the rest of the batch and a halted FX0A
+            # would not move, so the batch counts as fully run, as if it had spun
+            pc = self.pc
+            self.idle = True
+
+        self.pc = pc
+        self.cycles += count
+
+        return count
+
+    def run_frame(self, instructions_per_frame=None, present=True):
+        """
+        Runs one host frame: a batch of instructions, one timer tick and at most one
+        screen update. Returns the number of instructions executed.
+
+        The timers tick once per `instructions_per_frame` instructions executed (see
+        timer_ticks), so they keep pace with the CPU at any batch size or turbo speed.
+
+        With present=False nothing is drawn; changes stay tracked for the next frame
+        that does present. In turbo mode (see set_turbo) one call runs several
+        emulated frames and only every frame_skip-th call presents. Afterwards
+        self.idle tells whether the program was only waiting for the next tick.
+        """
+
+        if not self.running:
+            return 0
+
+        if instructions_per_frame is None:
+            instructions_per_frame = self.instructions_per_frame
+        if instructions_per_frame != self.cycles_per_tick:
+            self.set_cycles_per_tick(instructions_per_frame)
+
+        if self.release_queue:
+            self.check_keypress_timestamps()
+
+        if self.turbo == 1:
+            executed = self.run_cycles(instructions_per_frame)
+        else:
+            executed = 0
+            for _ in range(self.turbo):
+                executed += self.run_cycles(instructions_per_frame)
+        self.update_timers()
+
+        self.frame_count += 1
+
+        if present and self.display_dirty and self.frame_count % self.frame_skip == 0:
+            self.draw_screen()
+            self.display_dirty = False
+            if self.latency_pending:
+                self.record_latency()
+
+        return executed
+
+    def run_queued_input(self, count):
+        """
+        Runs a batch of `count` instructions in pieces, applying each queued key event
+        at its cycle. Events past the end of the batch stay queued.
+        """
+
+        queue = self.input_queue
+        # run_cycles below must not see the queue again
+        self.input_queue = []
+        end = self.cycles + count - self.cycle_debt
+        executed = 0
+
+        while True:
+            self.apply_input(queue)
+            if self.cycles >= end or not self.running:
+                break
+            stop = end
+            if queue and queue[0][0] < end:
+                stop = queue[0][0]
+            # pieces run up to a cycle number, so the debt is already accounted for
+            self.cycle_debt = 0
+            executed += self.run_cycles(stop - self.cycles)
+
+        self.cycle_debt = self.cycles - end if self.cycles > end else 0
+        self.input_queue = queue
+        return executed
+
+    def apply_input(self, queue):
+        """Applies the events in `queue` that are due by the current cycle."""
+
+        while queue and queue[0][0] <= self.cycles:
+            cycle, key, pressed, timestamp = queue.pop(0)
+            self.set_key(key, pressed)
+            if pressed and self.latency_samples is not None:
+                self.latency_pending.append(timestamp)
+
+    def set_latency_tracking(self, enabled):
+        """
+        Turns input latency tracking on or off.
+
+        For every queued key press, the time from its host timestamp to the end of the
+        first presented frame that changed the screen after the press was applied is
+        recorded; see latency_snapshot.
+        """
+
+        self.latency_samples = [] if enabled else None
+        self.latency_pending.clear()
+
+    def record_latency(self):
+        if self.latency_samples is not None:
+            now = time.ticks_ms()
+            for timestamp in self.latency_pending:
+                self.latency_samples.append(ticks_diff(now, timestamp))
+        self.latency_pending.clear()
+
+    def latency_snapshot(self):
+        """
+        Returns the input latency measured since set_latency_tracking(True), or None.
+
+        "presses" is the number of key presses measured, "pending" those applied but not
+        presented yet, and "min_ms", "p50_ms", "p99_ms" and "max_ms" summarize the
+        samples (None before the first one).
+        """
+
+        if self.latency_samples is None:
+            return None
+
+        samples = sorted(self.latency_samples)
+        count = len(samples)
+        snapshot = {"presses": count, "pending": len(self.latency_pending)}
+        if count:
+            snapshot["min_ms"] = samples[0]
+            snapshot["p50_ms"] = samples[count // 2]
+            snapshot["p99_ms"] = samples[min(count - 1, count * 99 // 100)]
+            snapshot["max_ms"] = samples[-1]
+        else:
+            snapshot["min_ms"] = snapshot["p50_ms"] = snapshot["p99_ms"] = snapshot["max_ms"] = None
+        return snapshot
+
+    def set_turbo(self, speed=1, frame_skip=1):
+        """
+        Fast-forwards at `speed` emulated frames per run_frame, presenting every `frame_skip` calls.
+
+        set_turbo() with no arguments returns to normal speed.
+        """
+
+        self.turbo = max(1, int(speed))
+        self.frame_skip = max(1, int(frame_skip))
+
+    def measure_allocations(self, cycles=1000, batch=10):
+        """
+        Runs `cycles` instructions in batches of `batch` and reports heap activity.
+
+        Returns a dict with "cycles", "bytes" (heap bytes allocated) and "collections"
+        (garbage collections that ran). On MicroPython this uses gc.mem_alloc(): growth
+        between batches counts as allocation, and a drop means the GC ran. On CPython
+        "bytes" is the net growth of allocated blocks reported by tracemalloc and
+        "collections" comes from gc.get_stats().
+        """
+
+        executed = 0
+        allocated = 0
+        collections = 0
+
+        if hasattr(gc, "mem_alloc"):
+            gc.collect()
+            before = gc.mem_alloc()
+            while executed < cycles:
+                executed += self.run_cycles(min(batch, cycles - executed))
+                after = gc.mem_alloc()
+                if after < before:
+                    collections += 1
+                else:
+                    allocated += after - before
+                before = after
+        else:
+            import tracemalloc
+
+            tracing = tracemalloc.is_tracing()
+            if not tracing:
+                tracemalloc.start()
+            collections = -sum(stats["collections"] for stats in gc.get_stats())
+            before = tracemalloc.get_traced_memory()[0]
+            while executed < cycles:
+                executed += self.run_cycles(min(batch, cycles - executed))
+            allocated = tracemalloc.get_traced_memory()[0] - before
+            collections += sum(stats["collections"] for stats in gc.get_stats())
+            if not tracing:
+                tracemalloc.stop()
+
+        return {"cycles": executed, "bytes": allocated, "collections": collections}
+
+    def timer_ticks(self):
+        """
+        Returns the 60 Hz timer ticks since reset, derived from the instruction count.
+
+        A running batch sees the count as of its start, so the timers only move between
+        batches, as they did when they were decremented once per frame.
+        """
+
+        return self.tick_base + (self.cycles - self.tick_base_cycle) // self.cycles_per_tick
+
+    def set_cycles_per_tick(self, cycles_per_tick):
+        """
+        Sets how many instructions make up one timer tick.
+
+        The ticks elapsed so far and the progress into the current one are kept, so
+        running timers do not jump.
+        """
+
+        elapsed = self.cycles - self.tick_base_cycle
+        self.tick_base += elapsed // self.cycles_per_tick
+        self.tick_base_cycle = self.cycles - elapsed % self.cycles_per_tick
+        self.cycles_per_tick = max(1, cycles_per_tick)
+
+    @property
+    def delay_timer(self):
+        remaining = self.delay_deadline - self.timer_ticks()
+        return remaining if remaining > 0 else 0
+
+    @delay_timer.setter
+    def delay_timer(self, value):
+        self.delay_deadline = self.timer_ticks() + value
+
+    @property
+    def sound_timer(self):
+        remaining = self.sound_deadline - self.timer_ticks()
+        return remaining if remaining > 0 else 0
+
+    @sound_timer.setter
+    def sound_timer(self, value):
+        self.sound_deadline = self.timer_ticks() + value
+
+    def update_timers(self):
+        """
+        Reports this frame's sound changes to play_audio_callback, once per frame.
+
+        Nothing is counted down here; the sound plays while the sound timer's deadline
+        is ahead, and for at least one frame after an FX18. The callback runs with the
+        new state when the sound starts or stops, and with True again when F002 / FX3A
+        changed the XO-CHIP pattern or pitch of a playing sound. No instruction calls
+        into the frontend.
+        """
+
+        playing = self.sound_started or self.sound_deadline > self.timer_ticks()
+        self.sound_started = False
+        changed = playing != self.is_sound_playing or (playing and self.audio_changed)
+        if playing:
+            self.audio_changed = False
+        if changed:
+            self.is_sound_playing = playing
+            if self.play_audio_callback:
+                self.play_audio_callback(playing)
 
     # Convert screen buffer to display format (replace with your specific implementation)
     def draw_screen(self):
-
-        for y in range(32):
-            row_start = y * 64
-            for x in range(64):
-                # index = y * 64 + x
-                pixel_value = self.screen[row_start + x]
-
-                if pixel_value == 1:
-
-                    # if self.use_color_mode:
-                    #     (r, g, b) = (
-                    #         random.getrandbits(8),
-                    #         random.getrandbits(8),
-                    #         random.getrandbits(8),
-                    #     )
-                    # else:
-                    #     (r, g, b) = 255, 255, 255
-
-                    self.draw_pixel_callback(x, y, self.scale, True)
-                elif pixel_value == 0:
-                    # (r, g, b) = 0, 0, 0
-
-                    self.draw_pixel_callback(x, y, self.scale, False)
+        """
+        Sends the pixels that changed since the last call to the frontend.
+
+        Only rows touched since then are compared against what was presented, and only
+        within the column span that was touched. With a draw_span_callback each row's
+        changed range is sent as runs of identical pixels instead of pixel by pixel, and
+        with a draw_byte_callback each byte of the row with a changed pixel is sent
+        whole, which is at most 8 (16 in hi-res) calls per row.
+        """
+
+        draw_pixel_callback = self.draw_pixel_callback
+        draw_span_callback = self.draw_span_callback
+        draw_byte_callback = self.draw_byte_callback
+        scale = self.scale
+        screen = self.screen
+        presented = self.presented
+        dirty_lo = self.dirty_lo
+        dirty_hi = self.dirty_hi
+        redraw_all = self.redraw_all
+        self.redraw_all = False
+        top = self.columns - 1
+
+        for y in range(self.rows):
+            line = screen[y]
+            if redraw_all:
+                lo = 0
+                hi = top
+                changed = self.row_mask
+            else:
+                lo = dirty_lo[y]
+                hi = dirty_hi[y]
+                if lo > hi:
+                    continue
+                changed = line ^ presented[y]
+
+            presented[y] = line
+            dirty_lo[y] = 0xFF
+            dirty_hi[y] = 0
+
+            if not changed:
+                continue
+
+            if draw_byte_callback is not None:
+                for column in range(lo >> 3, (hi >> 3) + 1):
+                    shift = top - 7 - (column << 3)
+                    if (changed >> shift) & 0xFF:
+                        draw_byte_callback(column, y, (line >> shift) & 0xFF)
+                continue
+
+            if draw_span_callback is None:
+                for x in range(lo, hi + 1):
+                    if (changed >> (top - x)) & 1:
+                        draw_pixel_callback(x, y, scale, (line >> (top - x)) & 1 == 1)
+                continue
+
+            # narrow the span down to the first and last pixel that flipped
+            while not (changed >> (top - lo)) & 1:
+                lo += 1
+            while not (changed >> (top - hi)) & 1:
+                hi -= 1
+
+            x = lo
+            while x <= hi:
+                on = (line >> (top - x)) & 1
+                start = x
+                x += 1
+                while x <= hi and (line >> (top - x)) & 1 == on:
+                    x += 1
+                draw_span_callback(start, y, x - start, on == 1)
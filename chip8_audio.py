@@ -0,0 +1,109 @@
+# Audio scheduling for Chip8 frontends
+#
+# Chip8 calls play_audio_callback(playing) from update_timers, once per frame at most,
+# when the sound starts or stops or when an XO-CHIP ROM changes the pattern or pitch of
+# a playing sound. AudioScheduler turns that into synth commands and only sends one when
+# the command differs from the last one sent, so a frontend never repeats itself.
+#
+# XO-CHIP sound is a 16-byte pattern of 128 one-bit samples, looped at
+# 4000 * 2 ** ((pitch - 64) / 48) samples per second. Each pattern is rendered to a
+# waveform once and cached by its bytes. From the waveform a pulse tone is derived
+# (pulses per loop and duty cycle) for synths that cannot play samples, like AMY on Tulip.
+#
+# Commands passed to `send` are tuples:
+#   ("off",)                      silence
+#   ("beep",)                     the frontend's plain CHIP-8 buzzer
+#   ("tone", frequency, duty)     a pulse wave, frequency in Hz, duty 0.0-1.0
+#
+#   audio = AudioScheduler(send)
+#   chip8.play_audio_callback = lambda playing: audio.update(chip8)
+
+
+def pattern_rate(pitch):
+    """Returns the XO-CHIP sample rate in samples per second for pitch register `pitch`."""
+    return 4000 * 2 ** ((pitch - 64) / 48)
+
+
+def render_pattern(pattern, low=0, high=255):
+    """Returns the 128 samples of a 16-byte pattern as a bytearray, first bit first."""
+
+    samples = bytearray(128)
+    for k in range(128):
+        samples[k] = high if pattern[k >> 3] & (0x80 >> (k & 7)) else low
+    return samples
+
+
+class PatternTone:
+    """
+    A rendered XO-CHIP pattern: its samples, and the pulse tone closest to it.
+
+    `pulses` counts the rising edges per loop of the pattern (0 for a flat pattern,
+    which is silent) and `duty` is the fraction of samples that are high.
+    """
+
+    def __init__(self, pattern):
+        samples = render_pattern(pattern)
+        high = 0
+        pulses = 0
+        previous = samples[127]
+        for sample in samples:
+            if sample:
+                high += 1
+                if not previous:
+                    pulses += 1
+            previous = sample
+
+        self.samples = samples
+        self.pulses = pulses
+        self.duty = high / 128
+
+
+class AudioScheduler:
+    """
+    Sends `send(command)` for each change of a Chip8's sound, and never twice in a row.
+
+    Rendered patterns are kept in a cache of up to `cache_size` entries.
+    """
+
+    def __init__(self, send, cache_size=32):
+        self.send = send
+        self.cache_size = cache_size
+        self.tones = {}  # pattern bytes -> PatternTone
+        self.last_command = None
+
+    def tone(self, pattern):
+        """Returns the PatternTone of `pattern`, rendering it on first use."""
+
+        key = bytes(pattern)
+        tone = self.tones.get(key)
+        if tone is None:
+            if len(self.tones) >= self.cache_size:
+                self.tones.clear()
+            tone = PatternTone(key)
+            self.tones[key] = tone
+        return tone
+
+    def command(self, chip8):
+        """Returns the command for the current sound state of `chip8`."""
+
+        if not chip8.is_sound_playing:
+            return ("off",)
+        if not chip8.xo_audio:
+            return ("beep",)
+
+        tone = self.tone(chip8.audio_pattern)
+        if not tone.pulses:
+            return ("off",)
+        frequency = pattern_rate(chip8.audio_pitch) * tone.pulses / 128
+        return ("tone", round(frequency, 1), round(tone.duty, 3))
+
+    def update(self, chip8):
+        command = self.command(chip8)
+        if command != self.last_command:
+            self.last_command = command
+            self.send(command)
+
+    def stop(self):
+        if self.last_command is not None and self.last_command[0] != "off":
+            self.last_command = ("off",)
+            self.send(self.last_command)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""Runs a directory of Chip8 ROMs headless across worker processes
+
+Every .ch8 file under the directory is run for a fixed number of frames (or until a
+cycle count is reached) in a ProcessPoolExecutor. Each finished ROM is printed as
+one JSON line as soon as its worker is done, with the final framebuffer hash, the
+instruction count and the throughput, so large corpora can be diffed between commits.
+
+  python chip8_batch.py roms/
+  python chip8_batch.py roms/ --frames 1200 --engine recompiler --output results.jsonl
+  python chip8_batch.py roms/ --cycles 100000 --workers 4
+
+Each worker builds one Chip8 and reuses it for every ROM it is given through reset().
+All ROMs start from the same RNG seed, so the hashes are reproducible.
+
+"""
+import argparse, hashlib, json, os, sys, time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from chip8_bench import NullFrontend, install_time_shim
+
+install_time_shim()
+
+from chip8 import Chip8, QUIRK_PROFILES
+
+# the Chip8 this worker process reuses for every ROM, created by init_worker
+worker_chip8 = None
+
+
+def init_worker(engine, quirks):
+    global worker_chip8
+
+    frontend = NullFrontend()
+    worker_chip8 = Chip8(1024, 600, frontend.draw_pixel, frontend.play_audio, frontend.draw_span)
+    worker_chip8.set_engine(engine)
+    worker_chip8.set_quirks(quirks)
+
+
+def run_rom(path, frames, cycles, instructions_per_frame, seed):
+    """
+    Runs one ROM on this worker's Chip8 and returns its result dict.
+
+    Runs `frames` frames, or with `cycles` set, frames until that many instructions
+    have executed. Errors raised by the emulator are reported in the result instead
+    of stopping the batch.
+    """
+
+    chip8 = worker_chip8
+    result = {"rom": path, "pid": os.getpid()}
+
+    try:
+        with open(path, "rb") as f:
+            rom = f.read()
+
+        chip8.reset()
+        chip8.load_rom(rom)
+        chip8.seed(seed)
+        chip8.start()
+
+        frames_run = 0
+        perf_counter = time.perf_counter
+        started = perf_counter()
+        if cycles is None:
+            for _ in range(frames):
+                chip8.run_frame(instructions_per_frame, present=False)
+            frames_run = frames
+        else:
+            while chip8.cycles < cycles and chip8.running:
+                chip8.run_frame(instructions_per_frame, present=False)
+                frames_run += 1
+        elapsed = perf_counter() - started
+
+        result.update(
+            {
+                "rom_sha256": hashlib.sha256(rom).hexdigest(),
+                "frames": frames_run,
+                "cycles": chip8.cycles,
+                "seconds": elapsed,
+                "ips": chip8.cycles / elapsed if elapsed else 0.0,
+                "screen_sha1": hashlib.sha1(bytes(chip8.screen_bytes())).hexdigest(),
+                "hires": chip8.hires,
+                "running": chip8.running,
+                "unknown_opcodes": chip8.unknown_opcode_count,
+            }
+        )
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+
+    return result
+
+
+def find_roms(directory):
+    """Returns the paths of all .ch8 files under `directory`, sorted."""
+
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            if name.lower().endswith(".ch8"):
+                paths.append(os.path.join(root, name))
+    paths.sort()
+    return paths
+
+
+def run_batch(
+    paths,
+    frames=600,
+    cycles=None,
+    instructions_per_frame=10,
+    engine="interpreter",
+    workers=None,
+    seed=0x1234,
+    quirks="default",
+):
+    """
+    Runs every ROM in `paths` across `workers` processes (default: one per core).
+
+    Yields each ROM's result dict in the order the workers finish.
+    """
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_worker, initargs=(engine, quirks)
+    ) as executor:
+        futures = [
+            executor.submit(run_rom, path, frames, cycles, instructions_per_frame, seed)
+            for path in paths
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory")
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument("--cycles", type=int, help="run until this many instructions instead of --frames")
+    parser.add_argument("--ipf", type=int, default=10, help="instructions per frame")
+    parser.add_argument("--engine", default="interpreter", choices=("interpreter", "recompiler"))
+    parser.add_argument("--workers", type=int, help="worker processes, one per core by default")
+    parser.add_argument("--seed", type=int, default=0x1234)
+    parser.add_argument("--quirks", default="default", choices=sorted(QUIRK_PROFILES))
+    parser.add_argument("--output", help="also write the JSON lines to this file")
+    args = parser.parse_args()
+
+    paths = find_roms(args.directory)
+    output = open(args.output, "w") if args.output else None
+
+    started = time.perf_counter()
+    total_cycles = 0
+    for result in run_batch(
+        paths, args.frames, args.cycles, args.ipf, args.engine, args.workers, args.seed, args.quirks
+    ):
+        line = json.dumps(result, sort_keys=True)
+        print(line, flush=True)
+        if output:
+            output.write(line + "\n")
+        total_cycles += result.get("cycles", 0)
+    elapsed = time.perf_counter() - started
+
+    if output:
+        output.close()
+
+    sys.stderr.write(
+        "%d ROMs, %d cycles in %.2f s: %.0f ips overall\n"
+        % (len(paths), total_cycles, elapsed, total_cycles / elapsed if elapsed else 0.0)
+    )
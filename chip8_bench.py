@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+"""Headless Chip8 benchmarks
+
+Runs chip8.py on a normal machine, without Tulip, against a set of small synthetic
+ROMs that each stress one part of the emulator, plus programs/slipperyslope.ch8.
+For every ROM, engine and instructions-per-frame setting it reports instructions per
+second, frames per second and per-frame latency percentiles.
+
+  python chip8_bench.py
+  python chip8_bench.py --frames 1200 --output bench.json
+  python chip8_bench.py --output new.json --compare bench.json
+
+Results are saved as JSON so runs from different commits can be compared.
+
+"""
+import argparse, json, os, platform, subprocess, sys, time
+
+
+def install_time_shim():
+    """chip8.py uses MicroPython's time.ticks_ms(); provide it on CPython."""
+
+    if not hasattr(time, "ticks_ms"):
+        time.ticks_ms = lambda: time.monotonic_ns() // 1000000
+
+
+install_time_shim()
+
+from chip8 import Chip8
+
+
+class NullFrontend:
+    """Draw/audio callbacks that only count how often they are called."""
+
+    def __init__(self):
+        self.pixel_calls = 0
+        self.span_calls = 0
+        self.byte_calls = 0
+        self.audio_calls = 0
+
+    def draw_pixel(self, x, y, pixel_scale, pixel_on=True):
+        self.pixel_calls += 1
+
+    def draw_span(self, x, y, length, pixel_on=True):
+        self.span_calls += 1
+
+    def draw_byte(self, column, y, bits):
+        self.byte_calls += 1
+
+    def play_audio(self, play=False):
+        self.audio_calls += 1
+
+
+class RecordingFrontend(NullFrontend):
+    """
+    Callbacks that keep an image of what the frontend would show.
+
+    Set it as the Chip8's resolution_callback too so the image follows 00FE/00FF.
+    """
+
+    def __init__(self):
+        NullFrontend.__init__(self)
+        self.columns = 64
+        self.pixels = bytearray(64 * 32)
+
+    def resolution_changed(self, columns, rows):
+        self.columns = columns
+        self.pixels = bytearray(columns * rows)
+
+    def draw_pixel(self, x, y, pixel_scale, pixel_on=True):
+        self.pixel_calls += 1
+        self.pixels[y * self.columns + x] = 1 if pixel_on else 0
+
+    def draw_span(self, x, y, length, pixel_on=True):
+        self.span_calls += 1
+        row = y * self.columns
+        for col in range(x, x + length):
+            self.pixels[row + col] = 1 if pixel_on else 0
+
+    def draw_byte(self, column, y, bits):
+        self.byte_calls += 1
+        row = y * self.columns + column * 8
+        for bit in range(8):
+            self.pixels[row + bit] = (bits >> (7 - bit)) & 1
+
+
+def assemble(*opcodes):
+    rom = bytearray()
+    for opcode in opcodes:
+        rom.append(opcode >> 8)
+        rom.append(opcode & 0xFF)
+    return bytes(rom)
+
+
+def load_program(name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "programs", name)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# name -> ROM bytes
+ROMS = {
+    # 8XYN arithmetic in a loop
+    "alu": assemble(
+        0x6001, 0x6103, 0x6207,
+        0x8014, 0x8125, 0x8216, 0x8017, 0x801E, 0x8231, 0x8302, 0x8413, 0x7401,
+        0x1206,
+    ),
+    # font digits drawn all over the screen
+    "sprites": assemble(
+        0x6000, 0x6100, 0x6200, 0x630F,
+        0xF229, 0xD015, 0x7005, 0x7103, 0x7201, 0x8232,
+        0x1208,
+    ),
+    # BCD and register block stores/loads
+    "memory": assemble(
+        0x6064,
+        0xA300, 0xF033, 0xF755, 0xA300, 0xF765, 0x7001,
+        0x1202,
+    ),
+    # a counter bouncing through a chain of jumps
+    "jumps": assemble(
+        0x7001, 0x1206, 0x1200, 0x1204,
+    ),
+    # 128x64 mode: 16x16 sprites while scrolling down and right
+    "hires": assemble(
+        0x00FF, 0x6000, 0x6100, 0xA050,
+        0xD010, 0x7011, 0x7107, 0x00C1, 0x00FB,
+        0x1208,
+    ),
+    # a delay timer poll loop, fast-forwarded by idle detection
+    "idle": assemble(
+        0x6F3C, 0xFF15,
+        0xFF07, 0x3F00, 0x1204,
+        0x1200,
+    ),
+    "slipperyslope": load_program("slipperyslope.ch8"),
+}
+
+ENGINES = ("interpreter", "recompiler")
+
+INSTRUCTIONS_PER_FRAME = (10, 200)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_benchmark(rom, engine, instructions_per_frame, frames, span_callback=True):
+    """Runs `frames` frames of `rom` and returns a result dict."""
+
+    frontend = NullFrontend()
+    chip8 = Chip8(
+        1024,
+        600,
+        frontend.draw_pixel,
+        frontend.play_audio,
+        frontend.draw_span if span_callback else None,
+    )
+    chip8.set_engine(engine)
+    chip8.load_rom(rom)
+    chip8.start()
+
+    frame_times = []
+    instructions = 0
+    perf_counter = time.perf_counter
+
+    started = perf_counter()
+    for _ in range(frames):
+        frame_started = perf_counter()
+        instructions += chip8.run_frame(instructions_per_frame)
+        frame_times.append(perf_counter() - frame_started)
+    elapsed = perf_counter() - started
+
+    frame_times.sort()
+
+    return {
+        "engine": engine,
+        "instructions_per_frame": instructions_per_frame,
+        "frames": frames,
+        "instructions": instructions,
+        "seconds": elapsed,
+        "ips": instructions / elapsed if elapsed else 0.0,
+        "fps": frames / elapsed if elapsed else 0.0,
+        "frame_ms": {
+            "p50": percentile(frame_times, 0.50) * 1000,
+            "p90": percentile(frame_times, 0.90) * 1000,
+            "p99": percentile(frame_times, 0.99) * 1000,
+            "max": frame_times[-1] * 1000 if frame_times else 0.0,
+        },
+        "draw_calls": frontend.pixel_calls + frontend.span_calls + frontend.byte_calls,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(frames, roms=None, engines=ENGINES, instructions_per_frame=INSTRUCTIONS_PER_FRAME):
+    results = []
+    for name in roms or ROMS:
+        for engine in engines:
+            for ipf in instructions_per_frame:
+                result = run_benchmark(ROMS[name], engine, ipf, frames)
+                result["rom"] = name
+                results.append(result)
+                print(
+                    "%-14s %-12s ipf=%-5d %12.0f ips %9.1f fps  p50 %.3f ms  p99 %.3f ms"
+                    % (
+                        name,
+                        engine,
+                        ipf,
+                        result["ips"],
+                        result["fps"],
+                        result["frame_ms"]["p50"],
+                        result["frame_ms"]["p99"],
+                    )
+                )
+    return {
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+def compare(report, baseline):
+    """Prints the ips ratio of every result in `report` against `baseline`."""
+
+    def key(result):
+        return (result["rom"], result["engine"], result["instructions_per_frame"])
+
+    previous = dict((key(result), result) for result in baseline["results"])
+    print("\ncompared with %s" % baseline.get("revision"))
+    for result in report["results"]:
+        old = previous.get(key(result))
+        if old is None or not old["ips"]:
+            continue
+        print("%-14s %-12s ipf=%-5d %6.2fx" % (key(result) + (result["ips"] / old["ips"],)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument("--rom", action="append", choices=sorted(ROMS), help="limit to these ROMs")
+    parser.add_argument("--engine", action="append", choices=ENGINES, help="limit to these engines")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON file from an earlier run to compare against")
+    args = parser.parse_args()
+
+    report = run_suite(args.frames, args.rom, args.engine or ENGINES)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
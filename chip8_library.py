@@ -0,0 +1,151 @@
+import binascii, hashlib, json, os
+
+# ROM library for Chip8
+#
+# Scans a directory of .ch8 files once and indexes every ROM by content hash, file
+# name and size. The most recently used ROM images stay in memory, keyed by hash, so
+# switching between games does not go back to the filesystem. Runs on MicroPython
+# (Tulip) as well as desktop Python.
+#
+# An optional quirks.json next to the ROMs maps a file name or sha256 to a quirk
+# profile name or a dict of quirk flags (see chip8.QUIRK_PROFILES), applied on load:
+#
+#   {"blinky.ch8": "schip", "3f5a...": {"shift_vy": true}}
+#
+#   library = RomLibrary("programs")
+#   library.scan()
+#   library.load(chip8, "slipperyslope.ch8")
+
+
+class RomEntry:
+    """One indexed ROM: its file name, path, size in bytes and sha256 hex digest."""
+
+    def __init__(self, name, path, size, sha256):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+
+
+def rom_hash(image):
+    return binascii.hexlify(hashlib.sha256(image).digest()).decode()
+
+
+class RomLibrary:
+    """
+    Index of the ROMs in `directory` with an LRU cache of up to `cache_size` images.
+
+    Entries are found by file name or by sha256 hex digest. Two files with the same
+    contents share one cached image.
+    """
+
+    def __init__(self, directory="programs", cache_size=8):
+        self.directory = directory
+        self.cache_size = cache_size
+
+        self.entries = []  # sorted by name
+        self.by_name = {}
+        self.by_hash = {}
+
+        self.quirks = {}  # file name or sha256 -> quirk profile, from quirks.json
+
+        self.cache = {}  # sha256 -> image
+        self.cache_order = []  # sha256 digests, least recently used first
+
+    def scan(self):
+        """Re-indexes the directory and returns the number of ROMs found."""
+
+        entries = []
+        by_name = {}
+        by_hash = {}
+
+        for name in sorted(os.listdir(self.directory)):
+            if not name.lower().endswith(".ch8"):
+                continue
+            path = self.directory + "/" + name
+            with open(path, "rb") as f:
+                image = f.read()
+
+            entry = RomEntry(name, path, len(image), rom_hash(image))
+            entries.append(entry)
+            by_name[name] = entry
+            if entry.sha256 not in by_hash:
+                by_hash[entry.sha256] = entry
+            self.remember(entry.sha256, image)
+
+        self.entries = entries
+        self.by_name = by_name
+        self.by_hash = by_hash
+
+        try:
+            with open(self.directory + "/quirks.json") as f:
+                self.quirks = json.load(f)
+        except OSError:
+            self.quirks = {}
+
+        return len(entries)
+
+    def find(self, key):
+        """Returns the entry with file name or sha256 `key`, or None."""
+
+        entry = self.by_name.get(key)
+        if entry is None:
+            entry = self.by_hash.get(key)
+        return entry
+
+    def quirks_for(self, entry):
+        """Returns the quirk profile for `entry`: by hash, then by name, else "default"."""
+
+        quirks = self.quirks.get(entry.sha256)
+        if quirks is None:
+            quirks = self.quirks.get(entry.name, "default")
+        return quirks
+
+    def image(self, entry):
+        """
+        Returns the ROM image of `entry`, from the cache if it is there.
+
+        On a miss the file is read again and must still hash to what scan() saw,
+        otherwise ValueError is raised so a stale index is noticed.
+        """
+
+        image = self.cache.get(entry.sha256)
+        if image is not None:
+            self.cache_order.remove(entry.sha256)
+            self.cache_order.append(entry.sha256)
+            return image
+
+        with open(entry.path, "rb") as f:
+            image = f.read()
+        if rom_hash(image) != entry.sha256:
+            raise ValueError("%s changed since the library was scanned" % entry.path)
+
+        self.remember(entry.sha256, image)
+        return image
+
+    def remember(self, sha256, image):
+        if sha256 in self.cache:
+            self.cache_order.remove(sha256)
+        elif len(self.cache_order) >= self.cache_size:
+            del self.cache[self.cache_order.pop(0)]
+        self.cache[sha256] = image
+        self.cache_order.append(sha256)
+
+    def load(self, chip8, key):
+        """
+        Resets `chip8`, loads the ROM with file name or sha256 `key` and starts it.
+
+        The ROM's quirk profile is applied first. Returns the entry; raises KeyError if
+        the library has no such ROM.
+        """
+
+        entry = self.find(key)
+        if entry is None:
+            raise KeyError(key)
+
+        chip8.set_quirks(self.quirks_for(entry))
+        chip8.reset()
+        chip8.load_rom(self.image(entry))
+        chip8.start()
+
+        return entry
@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+
+"""Vectorized Chip8 engine that steps many machines in lockstep
+
+Chip8Array holds N independent CHIP-8 machines as NumPy arrays (memory (N, 4096),
+registers (N, 16), screens (N, 32, 64), ...) and executes one instruction on all of
+them per step. Each step fetches every machine's opcode, groups the machines by
+opcode family and applies that family's semantics to the group with masked array
+operations, so the Python overhead is paid once per step instead of once per machine.
+
+It is meant for search and reinforcement learning style experiments on desktop
+Python: run many copies of one ROM with different seeds and inputs. It follows
+chip8.Chip8 instruction for instruction for the base CHIP-8 set with the default
+quirks (and idle detection off, since skipped idle loops end at a different pc);
+SUPER-CHIP opcodes are counted as unknown.
+
+  python chip8_numpy.py programs/slipperyslope.ch8 --instances 4096 --frames 600
+  python chip8_numpy.py programs/slipperyslope.ch8 --verify 64
+
+"""
+import numpy as np
+
+from chip8_bench import install_time_shim
+
+install_time_shim()
+
+from chip8 import Chip8
+
+FONT_ADDRESS = 0x50
+
+# bit positions of a sprite byte's pixels, leftmost first
+SPRITE_SHIFTS = np.arange(7, -1, -1, dtype=np.uint8)
+SPRITE_COLUMNS = np.arange(8)
+SPRITE_ROWS = np.arange(15)
+
+
+class Chip8Array:
+    """
+    N CHIP-8 machines stored as arrays and executed in lockstep.
+
+    Main Attributes:
+        memory (uint8, (N, 4096)), v (int32, (N, 16)), stack (int32, (N, 16)),
+        pc, i, sp, delay_timer, sound_timer, rng_state (int32, (N,)),
+        keypad (bool, (N, 16)), screen (uint8, (N, 32, 64), one byte per pixel),
+        key_wait (int32, (N,), the register FX0A waits to load, -1 when running),
+        unknown_opcode_count (int32, (N,)).
+    """
+
+    def __init__(self, count, clip_columns=False, wrap_rows=False):
+        self.count = count
+
+        # Chip8's sprite quirks of the same names: by default sprite pixels past the
+        # right edge wrap around to the left and rows past the bottom are clipped
+        self.clip_columns = clip_columns
+        self.wrap_rows = wrap_rows
+
+        self.instances = np.arange(count)
+        self.memory = np.zeros((count, 4096), dtype=np.uint8)
+        self.v = np.zeros((count, 16), dtype=np.int32)
+        self.stack = np.zeros((count, 16), dtype=np.int32)
+        self.pc = np.zeros(count, dtype=np.int32)
+        self.i = np.zeros(count, dtype=np.int32)
+        self.sp = np.zeros(count, dtype=np.int32)
+        self.delay_timer = np.zeros(count, dtype=np.int32)
+        self.sound_timer = np.zeros(count, dtype=np.int32)
+        self.rng_state = np.zeros(count, dtype=np.int32)
+        self.keypad = np.zeros((count, 16), dtype=bool)
+        self.key_wait = np.full(count, -1, dtype=np.int32)
+        self.screen = np.zeros((count, 32, 64), dtype=np.uint8)
+        self.unknown_opcode_count = np.zeros(count, dtype=np.int32)
+
+        # memory as one flat array and each machine's offset into it, for fast fetches
+        self.bytes = self.memory.reshape(-1)
+        self.memory_base = self.instances * 4096
+
+        self.cycles = 0
+
+        # family handlers, called as handler(instances, opcodes, next_pc)
+        self.families = [
+            self.family_0,
+            self.family_1,
+            self.family_2,
+            self.family_3,
+            self.family_4,
+            self.family_5,
+            self.family_6,
+            self.family_7,
+            self.family_8,
+            self.family_9,
+            self.family_a,
+            self.family_b,
+            self.family_c,
+            self.family_d,
+            self.family_e,
+            self.family_f,
+        ]
+
+        # the same font Chip8 loads
+        self.fontset = np.array(Chip8(64, 32).fontset, dtype=np.uint8)
+
+        self.reset()
+
+    def reset(self):
+        self.memory[:] = 0
+        self.memory[:, FONT_ADDRESS : FONT_ADDRESS + len(self.fontset)] = self.fontset
+        self.v[:] = 0
+        self.stack[:] = 0
+        self.pc[:] = 0x200
+        self.i[:] = 0
+        self.sp[:] = 0
+        self.delay_timer[:] = 0
+        self.sound_timer[:] = 0
+        self.keypad[:] = False
+        self.key_wait[:] = -1
+        self.screen[:] = 0
+        self.unknown_opcode_count[:] = 0
+        self.cycles = 0
+        self.seed(np.arange(1, self.count + 1))
+
+    def seed(self, values):
+        """Seeds every machine's CXNN generator; `values` is one int or one per machine."""
+
+        values = np.broadcast_to(np.asarray(values, dtype=np.int32) & 0xFFFF, (self.count,))
+        self.rng_state[:] = np.where(values == 0, 0xACE1, values)
+
+    def load_rom(self, rom):
+        """Loads the same ROM into every machine."""
+        self.memory[:, 0x200 : 0x200 + len(rom)] = np.frombuffer(bytes(rom), dtype=np.uint8)
+
+    def set_key(self, instances, key, pressed):
+        """Sets `key` on the given machines; a press resumes those waiting in FX0A."""
+
+        if pressed:
+            r = np.atleast_1d(self.instances[instances])
+            r = r[~self.keypad[r, key] & (self.key_wait[r] >= 0)]
+            self.v[r, self.key_wait[r]] = key
+            self.pc[r] += 2
+            self.key_wait[r] = -1
+        self.keypad[instances, key] = pressed
+
+    def screen_bytes(self, instance):
+        """Returns one machine's framebuffer packed like Chip8.screen_bytes()."""
+        return np.packbits(self.screen[instance], axis=1).tobytes()
+
+    def run_cycles(self, count):
+        """Executes `count` instructions on every machine and returns how many each ran."""
+
+        for _ in range(count):
+            self.step()
+        self.cycles += count
+        return count
+
+    def run_frame(self, instructions_per_frame=10):
+        executed = self.run_cycles(instructions_per_frame)
+        self.update_timers()
+        return executed
+
+    def update_timers(self):
+        np.subtract(self.delay_timer, 1, out=self.delay_timer, where=self.delay_timer > 0)
+        np.subtract(self.sound_timer, 1, out=self.sound_timer, where=self.sound_timer > 0)
+
+    def step(self):
+        """Fetches one opcode per machine and runs each opcode family on its machines."""
+
+        pc = self.pc
+        instances = self.instances
+        base = self.memory_base
+        opcodes = (self.bytes[base + (pc & 0xFFF)].astype(np.int32) << 8) | self.bytes[
+            base + ((pc + 1) & 0xFFF)
+        ]
+        family = opcodes >> 12
+        next_pc = pc + 2
+
+        counts = np.bincount(family, minlength=16)
+        if counts[family[0]] == self.count:
+            # every machine is running the same kind of instruction
+            self.families[family[0]](instances, opcodes, next_pc)
+        else:
+            order = np.argsort(family, kind="stable")
+            start = 0
+            for f in range(16):
+                end = start + counts[f]
+                if end > start:
+                    selected = order[start:end]
+                    self.families[f](selected, opcodes[selected], next_pc)
+                start = end
+
+        self.pc = next_pc
+
+    def unknown(self, instances):
+        self.unknown_opcode_count[instances] += 1
+
+    # Opcode families. Each gets the machines running that family and their opcodes,
+    # and applies the instruction the way the matching Chip8.op_* closure does, in the
+    # same order so results agree even when X or Y is VF.
+
+    def family_0(self, s, ops, next_pc):
+        clear = ops == 0x00E0
+        ret = ops == 0x00EE
+        if clear.any():
+            self.screen[s[clear]] = 0
+        if ret.any():
+            r = s[ret]
+            self.sp[r] -= 1
+            next_pc[r] = self.stack[r, self.sp[r] & 15]
+        other = ~(clear | ret)
+        if other.any():
+            self.unknown(s[other])
+
+    def family_1(self, s, ops, next_pc):  # Jump to address NNN
+        next_pc[s] = ops & 0xFFF
+
+    def family_2(self, s, ops, next_pc):  # Call subroutine at NNN
+        self.stack[s, self.sp[s] & 15] = self.pc[s] + 2
+        self.sp[s] += 1
+        next_pc[s] = ops & 0xFFF
+
+    def family_3(self, s, ops, next_pc):  # Skip next instruction if VX == NN
+        skip = self.v[s, (ops >> 8) & 0xF] == ops & 0xFF
+        next_pc[s[skip]] += 2
+
+    def family_4(self, s, ops, next_pc):  # Skip next instruction if VX != NN
+        skip = self.v[s, (ops >> 8) & 0xF] != ops & 0xFF
+        next_pc[s[skip]] += 2
+
+    def family_5(self, s, ops, next_pc):  # Skip next instruction if VX == VY
+        skip = self.v[s, (ops >> 8) & 0xF] == self.v[s, (ops >> 4) & 0xF]
+        next_pc[s[skip]] += 2
+
+    def family_6(self, s, ops, next_pc):  # Set VX to NN
+        self.v[s, (ops >> 8) & 0xF] = ops & 0xFF
+
+    def family_7(self, s, ops, next_pc):  # Add NN to VX (no carry flag)
+        x = (ops >> 8) & 0xF
+        self.v[s, x] = (self.v[s, x] + (ops & 0xFF)) & 0xFF
+
+    def family_8(self, s, ops, next_pc):
+        v = self.v
+        n = ops & 0xF
+        for op in np.unique(n):
+            m = n == op
+            r = s[m]
+            x = (ops[m] >> 8) & 0xF
+            y = (ops[m] >> 4) & 0xF
+            if op == 0x0:
+                v[r, x] = v[r, y]
+            elif op == 0x1:
+                v[r, x] |= v[r, y]
+            elif op == 0x2:
+                v[r, x] &= v[r, y]
+            elif op == 0x3:
+                v[r, x] ^= v[r, y]
+            elif op == 0x4:
+                total = v[r, x] + v[r, y]
+                v[r, x] = total & 0xFF
+                v[r, 0xF] = total >> 8
+            elif op == 0x5:
+                v[r, 0xF] = v[r, x] > v[r, y]
+                v[r, x] = (v[r, x] - v[r, y]) & 0xFF
+            elif op == 0x6:
+                v[r, 0xF] = v[r, x] & 0x1
+                v[r, x] = v[r, x] >> 1
+            elif op == 0x7:
+                v[r, 0xF] = v[r, y] > v[r, x]
+                v[r, x] = (v[r, y] - v[r, x]) & 0xFF
+            elif op == 0xE:
+                v[r, 0xF] = (v[r, x] & 0x80) >> 7
+                v[r, x] = (v[r, x] << 1) & 0xFF
+            else:
+                self.unknown(r)
+
+    def family_9(self, s, ops, next_pc):  # Skip next instruction if VX != VY
+        skip = self.v[s, (ops >> 8) & 0xF] != self.v[s, (ops >> 4) & 0xF]
+        next_pc[s[skip]] += 2
+
+    def family_a(self, s, ops, next_pc):  # Set I to NNN
+        self.i[s] = ops & 0xFFF
+
+    def family_b(self, s, ops, next_pc):  # Jump to address NNN + V0
+        next_pc[s] = (ops & 0xFFF) + self.v[s, 0]
+
+    def family_c(self, s, ops, next_pc):  # Set VX to a random number AND NN
+        state = self.rng_state[s]
+        state ^= (state << 7) & 0xFFFF
+        state ^= state >> 9
+        state ^= (state << 8) & 0xFFFF
+        self.rng_state[s] = state
+        self.v[s, (ops >> 8) & 0xF] = state & ops & 0xFF
+
+    def family_d(self, s, ops, next_pc):  # Draw an 8xN sprite at (VX, VY)
+        """
+        Draws every machine's sprite at once.
+
+        The sprites are expanded into an (S, rows, 8) block of pixel bits, zeroed where
+        a machine's sprite has no such row or the pixel is clipped, and XORed into the
+        screens with one gather and one scatter. A sprite's rows never land on the same
+        screen row twice (N < 32), so the scatter has no duplicate indices. A machine
+        collides if any of its set pixels was already on.
+        """
+
+        v = self.v
+        x0 = v[s, (ops >> 8) & 0xF] & 63
+        y0 = v[s, (ops >> 4) & 0xF] & 31
+        n = ops & 0xF
+
+        rows = SPRITE_ROWS[: n.max()]
+        y = y0[:, None] + rows
+        active = rows < n[:, None]
+        columns = x0[:, None] + SPRITE_COLUMNS
+        if not self.wrap_rows:
+            active &= y < 32
+
+        addresses = self.memory_base[s][:, None] + ((self.i[s][:, None] + rows) & 0xFFF)
+        bits = (self.bytes[addresses][:, :, None] >> SPRITE_SHIFTS) & 1
+        bits *= active[:, :, None]
+        if self.clip_columns:
+            bits *= (columns < 64)[:, None, :]
+
+        # index the screens as one flat array, much cheaper than three fancy indices;
+        # clipped pixels wrap here but XOR nothing
+        pixels = self.screen.reshape(-1)
+        columns &= 63
+        index = (s * 2048)[:, None, None] + ((y & 31) * 64)[:, :, None] + columns[:, None, :]
+
+        old = pixels[index]
+        pixels[index] = old ^ bits
+        v[s, 0xF] = (old & bits).reshape(len(s), -1).any(axis=1)
+
+    def family_e(self, s, ops, next_pc):
+        nn = ops & 0xFF
+        x = (ops >> 8) & 0xF
+        pressed = self.keypad[s, self.v[s, x] & 0xF]
+        skip = ((nn == 0x9E) & pressed) | ((nn == 0xA1) & ~pressed)
+        next_pc[s[skip]] += 2
+        other = (nn != 0x9E) & (nn != 0xA1)
+        if other.any():
+            self.unknown(s[other])
+
+    def family_f(self, s, ops, next_pc):
+        v = self.v
+        memory = self.memory
+        nn = ops & 0xFF
+        for op in np.unique(nn):
+            m = nn == op
+            r = s[m]
+            x = (ops[m] >> 8) & 0xF
+            if op == 0x07:
+                v[r, x] = self.delay_timer[r]
+            elif op == 0x02 or op == 0x3A:
+                pass  # XO-CHIP audio pattern and pitch; there is no audio here
+            elif op == 0x0A:
+                # spin on the FX0A until set_key resumes the machine; Chip8 halts there
+                self.key_wait[r] = x
+                next_pc[r] = self.pc[r]
+            elif op == 0x15:
+                self.delay_timer[r] = v[r, x]
+            elif op == 0x18:
+                self.sound_timer[r] = v[r, x]
+            elif op == 0x1E:
+                self.i[r] = (self.i[r] + v[r, x]) & 0xFFFF
+            elif op == 0x29:
+                self.i[r] = v[r, x] * 5 + FONT_ADDRESS
+            elif op == 0x33:
+                digit = v[r, x]
+                i = self.i[r]
+                memory[r, i & 0xFFF] = digit // 100
+                memory[r, (i + 1) & 0xFFF] = (digit % 100) // 10
+                memory[r, (i + 2) & 0xFFF] = digit % 10
+            elif op == 0x55 or op == 0x65:
+                i = self.i[r]
+                for offset in range(16):
+                    within = offset <= x
+                    if not within.any():
+                        break
+                    machines = r[within]
+                    addresses = (i[within] + offset) & 0xFFF
+                    if op == 0x55:
+                        memory[machines, addresses] = v[machines, offset]
+                    else:
+                        v[machines, offset] = memory[machines, addresses]
+                self.i[r] = i + x + 1
+            else:
+                self.unknown(r)
+
+
+def key_schedule(instance, frame):
+    """The keypad change machine `instance` gets before `frame` in verify(): (key, pressed) or None."""
+
+    h = (instance * 2654435761 + frame * 40503) & 0xFFFFFFFF
+    if h % 7:
+        return None
+    return ((h >> 8) & 0xF, (h >> 12) & 1 == 1)
+
+
+def verify(rom, instances=16, frames=300, instructions_per_frame=10):
+    """
+    Runs `rom` on a Chip8Array and on one Chip8 per machine with the same seeds and
+    key presses, and returns the machines whose final state differs.
+    """
+
+    array = Chip8Array(instances)
+    array.load_rom(rom)
+
+    machines = []
+    for k in range(instances):
+        chip8 = Chip8(640, 320)
+        chip8.set_idle_detection(False)
+        chip8.auto_release = False
+        chip8.load_rom(rom)
+        chip8.seed(k + 1)
+        chip8.start()
+        machines.append(chip8)
+
+    for frame in range(frames):
+        for k in range(instances):
+            change = key_schedule(k, frame)
+            if change is not None:
+                array.set_key(k, change[0], change[1])
+                machines[k].set_key(change[0], change[1])
+        array.run_frame(instructions_per_frame)
+        for chip8 in machines:
+            chip8.run_frame(instructions_per_frame, present=False)
+
+    mismatches = []
+    for k, chip8 in enumerate(machines):
+        same = (
+            bytes(chip8.memory) == array.memory[k].tobytes()
+            and list(chip8.v) == array.v[k].tolist()
+            and chip8.i == array.i[k]
+            and chip8.pc == array.pc[k]
+            and chip8.sp == array.sp[k]
+            and list(chip8.stack[: chip8.sp]) == array.stack[k, : chip8.sp].tolist()
+            and chip8.delay_timer == array.delay_timer[k]
+            and chip8.sound_timer == array.sound_timer[k]
+            and bytes(chip8.screen_bytes()) == array.screen_bytes(k)
+        )
+        if not same:
+            mismatches.append(k)
+    return mismatches
+
+
+if __name__ == "__main__":
+    import argparse, time
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("rom")
+    parser.add_argument("--instances", type=int, default=1024)
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument("--ipf", type=int, default=10, help="instructions per frame")
+    parser.add_argument("--verify", type=int, metavar="N", help="compare N machines against Chip8 instead")
+    args = parser.parse_args()
+
+    with open(args.rom, "rb") as f:
+        rom = f.read()
+
+    if args.verify:
+        mismatches = verify(rom, args.verify, args.frames, args.ipf)
+        print("%d of %d machines differ from Chip8 %s" % (len(mismatches), args.verify, mismatches or ""))
+    else:
+        array = Chip8Array(args.instances)
+        array.load_rom(rom)
+        started = time.perf_counter()
+        for _ in range(args.frames):
+            array.run_frame(args.ipf)
+        elapsed = time.perf_counter() - started
+        total = array.cycles * args.instances
+        print(
+            "%d machines, %d instructions in %.2f s: %.0f aggregate ips"
+            % (args.instances, total, elapsed, total / elapsed if elapsed else 0.0)
+        )
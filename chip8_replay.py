@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""Deterministic input recording and replay for Chip8
+
+A recording is the RNG seed, the instructions per frame and every keypad change as
+a (cycle, key, down) event. Replaying it against the same ROM reproduces the run
+exactly, headless and as fast as the engine goes, which makes real gameplay usable
+for performance regression runs and for bisecting slowdowns.
+
+  python chip8_replay.py programs/slipperyslope.ch8 game.c8r
+  python chip8_replay.py programs/slipperyslope.ch8 game.c8r --engine recompiler
+
+Recording on the device:
+
+  recording = start_recording(chip8)
+  ...play...
+  stop_recording(chip8, recording)
+  with open("game.c8r", "wb") as f:
+      f.write(recording.to_bytes())
+
+"""
+import random, struct, time
+
+RECORDING_MAGIC = b"C8IR"
+RECORDING_VERSION = 2
+
+# magic, version, seed, instructions per frame, end cycle, event count
+RECORDING_HEADER = ">4sBHHQI"
+
+# cycles since the previous event, (key << 1) | down
+RECORDING_EVENT = ">IB"
+
+
+class InputRecording:
+    """
+    Seed, frame size and keypad events of a recorded run.
+
+    Each event is one int: (cycle << 5) | (key << 1) | down, where cycle is the
+    Chip8's instruction count when the key changed. On disk an event takes 5 bytes,
+    the cycles since the previous event and the key byte, so runs of any length fit;
+    to_bytes raises ValueError if 2**32 cycles pass without input.
+    """
+
+    def __init__(self, seed, instructions_per_frame, events=None, end_cycle=0):
+        self.seed = seed
+        self.instructions_per_frame = instructions_per_frame
+        self.events = events if events is not None else []
+        self.end_cycle = end_cycle
+
+    def to_bytes(self):
+        header = struct.pack(
+            RECORDING_HEADER,
+            RECORDING_MAGIC,
+            RECORDING_VERSION,
+            self.seed,
+            self.instructions_per_frame,
+            self.end_cycle,
+            len(self.events),
+        )
+        data = bytearray(header)
+        previous = 0
+        for event in self.events:
+            cycle = event >> 5
+            if cycle - previous > 0xFFFFFFFF:
+                raise ValueError("2**32 or more cycles without input before cycle %d" % cycle)
+            data += struct.pack(RECORDING_EVENT, cycle - previous, event & 0x1F)
+            previous = cycle
+        return bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        size = struct.calcsize(RECORDING_HEADER)
+        magic, version, seed, instructions_per_frame, end_cycle, count = struct.unpack(
+            RECORDING_HEADER, data[:size]
+        )
+        if magic != RECORDING_MAGIC or version != RECORDING_VERSION:
+            raise ValueError("Not a Chip8 input recording (version %d)" % RECORDING_VERSION)
+        events = []
+        cycle = 0
+        for delta, key in struct.iter_unpack(
+            RECORDING_EVENT, data[size : size + count * struct.calcsize(RECORDING_EVENT)]
+        ):
+            cycle += delta
+            events.append((cycle << 5) | key)
+        return cls(seed, instructions_per_frame, events, end_cycle)
+
+
+def start_recording(chip8, seed=None):
+    """
+    Starts logging the Chip8's keypad changes and returns the recording.
+
+    Call right after loading the ROM; the Chip8 is reseeded so the run can be replayed.
+    """
+
+    if seed is None:
+        seed = random.getrandbits(16)
+    chip8.seed(seed)
+    chip8.input_log = []
+    return InputRecording(seed, chip8.instructions_per_frame, chip8.input_log)
+
+
+def stop_recording(chip8, recording):
+    chip8.input_log = None
+    recording.end_cycle = chip8.cycles
+    return recording
+
+
+def replay(chip8, rom, recording):
+    """
+    Replays `recording` on `chip8` from a fresh load of `rom`, without drawing.
+
+    Key events are queued with the cycle they were recorded at, so they apply at that
+    exact instruction, and the wall clock key release is disabled because releases
+    are part of the log. Returns
+    a dict with the cycles and frames run and the instructions per second achieved.
+    """
+
+    chip8.reset()
+    chip8.load_rom(rom)
+    chip8.seed(recording.seed)
+    chip8.auto_release = False
+    chip8.start()
+
+    events = recording.events
+    next_event = 0
+    end_cycle = recording.end_cycle
+    instructions_per_frame = recording.instructions_per_frame
+    frames = 0
+
+    started = time.perf_counter()
+    while chip8.cycles < end_cycle and chip8.running:
+        frame_end = chip8.cycles + instructions_per_frame
+        while next_event < len(events) and events[next_event] >> 5 < frame_end:
+            event = events[next_event]
+            chip8.queue_key((event >> 1) & 0xF, event & 1 == 1, event >> 5, 0)
+            next_event += 1
+        chip8.run_frame(instructions_per_frame, present=False)
+        frames += 1
+    elapsed = time.perf_counter() - started
+
+    chip8.auto_release = True
+
+    return {
+        "cycles": chip8.cycles,
+        "frames": frames,
+        "seconds": elapsed,
+        "ips": chip8.cycles / elapsed if elapsed else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    import argparse, hashlib
+
+    from chip8_bench import NullFrontend, install_time_shim
+
+    install_time_shim()
+
+    from chip8 import Chip8
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("rom")
+    parser.add_argument("recording")
+    parser.add_argument("--engine", default="interpreter", choices=("interpreter", "recompiler"))
+    args = parser.parse_args()
+
+    with open(args.rom, "rb") as f:
+        rom = f.read()
+    with open(args.recording, "rb") as f:
+        recording = InputRecording.from_bytes(f.read())
+
+    frontend = NullFrontend()
+    chip8 = Chip8(1024, 600, frontend.draw_pixel, frontend.play_audio, frontend.draw_span)
+    chip8.set_engine(args.engine)
+    result = replay(chip8, rom, recording)
+
+    print(
+        "%d cycles, %d frames in %.3f s: %.0f ips, screen %s"
+        % (
+            result["cycles"],
+            result["frames"],
+            result["seconds"],
+            result["ips"],
+            hashlib.sha1(bytes(chip8.screen_bytes())).hexdigest()[:12],
+        )
+    )
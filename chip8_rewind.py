@@ -0,0 +1,176 @@
+from chip8 import STATE_MEMORY, STATE_SIZE
+
+# Rewind history for Chip8
+#
+# Every captured frame adds one entry that turns the state after that frame back
+# into the state before it. Most entries are deltas: the XOR of the two save_state
+# blobs, run-length encoded per 64 byte chunk, so a frame that only moved a sprite
+# costs a few dozen bytes. Every `keyframe_interval` frames the previous state is
+# stored whole instead, so long seeks can start from a keyframe rather than undo
+# every delta on the way.
+#
+# Delta format: for each changed chunk, the chunk index (one byte) followed by
+# tokens covering the chunk: 0-127 skips that many + 1 unchanged bytes, 128-255 is
+# followed by (token - 127) bytes to XOR in.
+
+CHUNK_SIZE = 64
+
+
+def encode_chunk(out, xor_bytes):
+    length = len(xor_bytes)
+    pos = 0
+    while pos < length:
+        start = pos
+        if xor_bytes[pos] == 0:
+            while pos < length and xor_bytes[pos] == 0 and pos - start < 128:
+                pos += 1
+            out.append(pos - start - 1)
+        else:
+            while pos < length and xor_bytes[pos] != 0 and pos - start < 128:
+                pos += 1
+            out.append(127 + pos - start)
+            out.extend(xor_bytes[start:pos])
+
+
+def apply_delta(buf, delta):
+    """XORs an encoded delta into `buf` in place."""
+
+    size = len(buf)
+    pos = 0
+    while pos < len(delta):
+        offset = delta[pos] * CHUNK_SIZE
+        end = min(offset + CHUNK_SIZE, size)
+        pos += 1
+        while offset < end:
+            token = delta[pos]
+            pos += 1
+            if token < 128:
+                offset += token + 1
+            else:
+                for k in range(token - 127):
+                    buf[offset + k] ^= delta[pos + k]
+                offset += token - 127
+                pos += token - 127
+
+
+class Rewind:
+    """
+    Keeps the last frames of a Chip8's state within a byte budget so it can step back.
+
+    Call capture() once per frame (after run_frame) and step_back() to rewind. When
+    the stored entries exceed `budget` bytes the oldest ones are dropped.
+    """
+
+    def __init__(self, chip8, budget=256 * 1024, keyframe_interval=120):
+        self.chip8 = chip8
+        self.budget = budget
+        self.keyframe_interval = keyframe_interval
+
+        # state as of the last capture, and the buffer the next capture is saved into
+        self.current = bytearray(STATE_SIZE)
+        self.scratch = bytearray(STATE_SIZE)
+        self.current_view = memoryview(self.current)
+        self.scratch_view = memoryview(self.scratch)
+
+        self.clear()
+
+    def clear(self):
+        """Forgets all history, e.g. after loading another ROM."""
+
+        self.entries = []  # (is_keyframe, data), oldest first
+        self.bytes_used = 0
+        self.has_current = False
+        self.frames_since_keyframe = 0
+
+    def frames(self):
+        """Returns how many frames can currently be rewound."""
+        return len(self.entries)
+
+    def capture(self):
+        """Records the Chip8's current state as the newest frame."""
+
+        new = self.scratch
+        self.chip8.save_state(new)
+
+        if self.has_current:
+            if self.frames_since_keyframe >= self.keyframe_interval:
+                entry = (True, bytes(self.current))
+                self.frames_since_keyframe = 0
+            else:
+                entry = (False, self.encode_delta())
+                self.frames_since_keyframe += 1
+
+            self.entries.append(entry)
+            self.bytes_used += len(entry[1])
+
+            while self.bytes_used > self.budget and self.entries:
+                self.bytes_used -= len(self.entries[0][1])
+                del self.entries[0]
+
+        # the new state becomes current; reuse the old buffer for the next capture
+        self.current, self.scratch = self.scratch, self.current
+        self.current_view, self.scratch_view = self.scratch_view, self.current_view
+        self.has_current = True
+
+    def encode_delta(self):
+        """Encodes the XOR of the scratch (newer) and current (older) states."""
+
+        new = self.scratch_view
+        old = self.current_view
+        delta = bytearray()
+
+        # memory rarely changes, so check it in one go before walking its chunks
+        memory_end = STATE_MEMORY + 4096
+        if new[STATE_MEMORY:memory_end] == old[STATE_MEMORY:memory_end]:
+            first_chunk = memory_end // CHUNK_SIZE
+        else:
+            first_chunk = 0
+
+        for chunk in range(first_chunk, (STATE_SIZE + CHUNK_SIZE - 1) // CHUNK_SIZE):
+            start = chunk * CHUNK_SIZE
+            end = min(start + CHUNK_SIZE, STATE_SIZE)
+            if new[start:end] == old[start:end]:
+                continue
+            xor = int.from_bytes(new[start:end], "big") ^ int.from_bytes(old[start:end], "big")
+            delta.append(chunk)
+            encode_chunk(delta, xor.to_bytes(end - start, "big"))
+
+        return bytes(delta)
+
+    def step_back(self, frames=1):
+        """
+        Rewinds the Chip8 by up to `frames` captured frames and returns how many it went back.
+
+        Starts from the keyframe closest to the target if one is in range, so the cost
+        is bounded by keyframe_interval deltas however far back the step goes.
+        """
+
+        entries = self.entries
+        count = len(entries)
+        frames = min(frames, count)
+        if frames <= 0:
+            return 0
+
+        target = count - frames
+
+        start = count
+        for k in range(target, count):
+            if entries[k][0]:
+                start = k
+                break
+
+        current = self.current
+        if start < count:
+            current[0:STATE_SIZE] = entries[start][1]
+
+        for k in range(start - 1, target - 1, -1):
+            apply_delta(current, entries[k][1])
+
+        for k in range(target, count):
+            self.bytes_used -= len(entries[k][1])
+        del entries[target:]
+
+        self.frames_since_keyframe = 0
+        self.chip8.load_state(current)
+
+        return frames
@@ -10,44 +10,168 @@ curl or wget can be used to send files with options similar to the following
 __Note__: curl automatically appends the filename onto the end of the URL so
 the path can be omitted.
 
+The file name comes from the Tulip-Filename header, or else from the URL path, and
+must stay inside the served directory. Each request runs in its own thread. An upload
+is streamed to a temporary file next to its target in CHUNK_SIZE pieces, fsynced and
+renamed over the target in one step, so readers never see a partial file. The reply is
+only sent once the file is on disk: 201 if it was created, 200 if it was replaced.
+
+  python file_server.py 8000 --bind 0.0.0.0 --directory programs
+
 """
-import os
-try:
-    import http.server as server
-except ImportError:
-    # Handle Python 2.x
-    import SimpleHTTPServer as server
+import argparse, functools, os, tempfile, urllib.parse
+
+import http.server as server
+
+# bytes read from the request and written to disk at a time, per upload
+CHUNK_SIZE = 64 * 1024
+
+# read once here, as setting it is not thread safe; uploads get the usual 0o666 & ~umask
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+class UploadError(Exception):
+    """An upload that cannot be completed; args are the HTTP status and message."""
+
 
 class HTTPRequestHandler(server.SimpleHTTPRequestHandler):
+    # HTTP/1.1 so clients sending "Expect: 100-continue" get their go-ahead
+    protocol_version = "HTTP/1.1"
+
     def do_PUT(self):
-        self.send_response(200)
+        try:
+            path = self.upload_path()
+            created = not os.path.exists(path)
+            self.receive_file(path)
+        except UploadError as e:
+            self.close_connection = True
+            self.send_error(*e.args)
+            return
+
+        self.send_response(201 if created else 200)
+        self.send_header("Content-Length", "0")
         self.end_headers()
-        print(str(self.headers))
-        path = self.headers['Tulip-Filename']
 
-        if "Content-Length" in self.headers:
-            content_length = int(self.headers["Content-Length"])
-            body = self.rfile.read(content_length)
-            with open(path, "wb") as out_file:
-                out_file.write(body)
-        elif "chunked" in self.headers.get("Transfer-Encoding", ""):
-            with open(path, "wb") as out_file:
-                while True:
-                    line = self.rfile.readline().strip()
-                    chunk_length = int(line, 16)
+    def upload_path(self):
+        """Returns the absolute path to save the upload to, inside the served directory."""
+
+        name = self.headers.get("Tulip-Filename")
+        if not name:
+            name = urllib.parse.unquote(self.path.split("?", 1)[0]).lstrip("/")
+        if not name:
+            raise UploadError(400, "No file name")
+
+        root = os.path.realpath(self.directory)
+        path = os.path.realpath(os.path.join(root, name))
+        if path == root or os.path.commonpath([root, path]) != root:
+            raise UploadError(403, "Outside of the served directory")
+        if os.path.isdir(path):
+            raise UploadError(409, "Is a directory")
+        return path
+
+    def receive_file(self, path):
+        """Streams the request body to `path`, replacing it atomically once durable."""
 
-                    if chunk_length != 0:
-                        chunk = self.rfile.read(chunk_length)
-                        out_file.write(chunk)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            raise UploadError(404, "No such directory")
 
-                    # Each chunk is followed by an additional empty newline
-                    # that we have to consume.
-                    self.rfile.readline()
+        descriptor, temporary = tempfile.mkstemp(
+            dir=directory, prefix="." + os.path.basename(path) + ".", suffix=".part"
+        )
+        try:
+            # mkstemp creates the file private to us
+            os.chmod(temporary, 0o666 & ~UMASK)
+            with os.fdopen(descriptor, "wb") as out_file:
+                if "Content-Length" in self.headers:
+                    try:
+                        length = int(self.headers["Content-Length"])
+                    except ValueError:
+                        raise UploadError(400, "Bad Content-Length")
+                    if length < 0:
+                        raise UploadError(400, "Bad Content-Length")
+                    self.copy_body(out_file, length)
+                elif "chunked" in self.headers.get("Transfer-Encoding", ""):
+                    self.copy_chunked_body(out_file)
+                else:
+                    raise UploadError(411, "Content-Length or chunked encoding required")
+                out_file.flush()
+                os.fsync(out_file.fileno())
+            os.replace(temporary, path)
+        except BaseException:
+            try:
+                os.unlink(temporary)
+            except OSError:
+                pass
+            raise
 
-                    # Finally, a chunk size of 0 is an end indication
-                    if chunk_length == 0:
-                        break
+        sync_directory(directory)
+
+    def copy_body(self, out_file, length):
+        while length > 0:
+            data = self.rfile.read(min(CHUNK_SIZE, length))
+            if not data:
+                raise UploadError(400, "Body shorter than Content-Length")
+            out_file.write(data)
+            length -= len(data)
+
+    def copy_chunked_body(self, out_file):
+        while True:
+            line = self.rfile.readline(1024)
+            try:
+                # chunk extensions after ";" are ignored
+                chunk_length = int(line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                raise UploadError(400, "Bad chunk size")
+
+            # Finally, a chunk size of 0 is an end indication
+            if chunk_length == 0:
+                break
+
+            self.copy_body(out_file, chunk_length)
+
+            # Each chunk is followed by an additional empty newline
+            # that we have to consume.
+            self.rfile.readline(1024)
+
+        # skip any trailer headers up to the closing empty line
+        while self.rfile.readline(1024).strip():
+            pass
+
+
+def sync_directory(directory):
+    """Makes a rename in `directory` durable, where the platform supports it."""
+
+    try:
+        descriptor = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
+
+
+class FileServer(server.ThreadingHTTPServer):
+    # room for a fleet of devices connecting at once
+    request_queue_size = 64
 
 
 if __name__ == '__main__':
-    server.test(HandlerClass=HTTPRequestHandler)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("port", type=int, nargs="?", default=8000)
+    parser.add_argument("--bind", default="", help="address to listen on, all by default")
+    parser.add_argument("--directory", default=os.getcwd(), help="directory to serve and save to")
+    args = parser.parse_args()
+
+    handler = functools.partial(HTTPRequestHandler, directory=args.directory)
+    with FileServer((args.bind, args.port), handler) as httpd:
+        host, port = httpd.socket.getsockname()[:2]
+        print("Serving %s on %s port %d" % (args.directory, host or "0.0.0.0", port))
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
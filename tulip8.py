@@ -2,41 +2,42 @@ import tulip, amy, music
 
 # local modules
 from chip8 import Chip8
+from chip8_audio import AudioScheduler
+from chip8_library import RomLibrary
+from chip8_rewind import Rewind
 
-chip8_program = "programs/slipperyslope.ch8"
+rom_directory = "programs"
+chip8_program = "slipperyslope.ch8"
+
+# offscreen part of the background plane (right of the 1024 visible columns) that holds
+# the tile atlas
+atlas_left = 1025
+atlas_right = 2048
 
 # Tulip 8 - A Chip 8 Simulator for Tulip CC
 
 
 class Tulip8(tulip.Game):
-    def __init__(self, initial_rom_path=None):
+    def __init__(self, initial_rom=None, keymap=None):
 
         self.KEY_P = [112, 80]
         self.KEY_ESC = [27]
+        self.KEY_BACKSPACE = [8]
+        self.KEY_TAB = [9]
+        self.KEY_N = [110, 78]
+        self.KEY_B = [98, 66]
 
-        self.KEY_1 = [49]
-        self.KEY_2 = [50]
-        self.KEY_3 = [51]
-        self.KEY_4 = [52]
-
-        self.KEY_Q = [113, 81]
-        self.KEY_W = [119, 87]
-        self.KEY_E = [101, 69]
-        self.KEY_R = [114, 82]
-
-        self.KEY_A = [97, 65]
-        self.KEY_S = [115, 83]
-        self.KEY_D = [100, 68]
-        self.KEY_F = [102, 70]
-
-        self.KEY_Z = [122, 90]
-        self.KEY_X = [120, 88]
-        self.KEY_C = [99, 67]
-        self.KEY_V = [118, 86]
+        # keypad keys pressed and not released yet
+        self.held_keys = []
 
         (self.SCREEN_WIDTH, self.SCREEN_HEIGHT) = tulip.screen_size()
 
-        self.initial_rom_path = initial_rom_path
+        self.initial_rom = initial_rom
+
+        # ROMs in rom_directory, N and B step to the next and previous one
+        self.library = RomLibrary(rom_directory)
+        self.library.scan()
+        self.rom_index = 0
 
         self.HALF_SCREEN_WIDTH = self.SCREEN_WIDTH / 2
         self.HALF_SCREEN_HEIGHT = self.SCREEN_HEIGHT / 2
@@ -54,30 +55,48 @@ class Tulip8(tulip.Game):
 
         tulip.gpu_reset()
 
+        # sound changes reported by the Chip8 once per frame, sent to AMY only when they differ
+        self.audio_osc = 100
+        self.audio = AudioScheduler(self.send_audio)
+
         # start CHIP-8 emulator
         self.chip8 = Chip8(
-            self.SCREEN_WIDTH, self.SCREEN_HEIGHT, self.draw_pixel, self.play_beep
+            self.SCREEN_WIDTH,
+            self.SCREEN_HEIGHT,
+            self.draw_pixel,
+            self.play_beep,
+            None,
+            self.draw_byte,
         )
         self.chip8.set_use_color_mode(False)
 
-        int_pixel_scale = int(self.chip8.scale)
+        # with real key-up information the Chip8 does not have to guess releases
+        self.chip8.auto_release = not hasattr(tulip, "keys")
 
-        tulip.bg_rect(
-            1025,
-            int_pixel_scale,
-            int_pixel_scale,
-            int_pixel_scale,
-            self.background_color,
-            self.render_filled,
-        )
-        tulip.bg_rect(
-            1025,
-            0,
-            int_pixel_scale,
-            int_pixel_scale,
-            self.foreground_color,
-            self.render_filled,
-        )
+        # host key code -> Chip-8 key lookup, see set_keymap
+        self.key_table = bytearray(b"\xff" * 256)
+        self.scan_codes = [0] * 16
+        self.set_keymap(keymap or self.chip8.key_map)
+
+        # rewind history, Backspace steps back rewind_step_frames frames
+        self.rewind = Rewind(self.chip8)
+        self.rewind_step_frames = 30
+
+        # Tab toggles fast-forward: turbo_speed x speed, presenting every turbo_frame_skip frames
+        self.turbo_speed = 8
+        self.turbo_frame_skip = 4
+
+        # SUPER-CHIP ROMs switch between 64x32 and 128x64
+        self.chip8.resolution_callback = self.resolution_changed
+
+        # offscreen atlas of all 256 eight-pixel row patterns; tile `bits` is at
+        # (atlas_x[bits], atlas_y[bits]), tile_width x scale pixels
+        self.atlas_key = None
+        self.atlas_x = [0] * 256
+        self.atlas_y = [0] * 256
+        self.tile_width = 0
+
+        self.prepare_pixel_tiles()
 
         # If scanning key codes in a program, you may want to turn on "key scan" mode so that
         # keys are not sent to the underlying python process
@@ -90,113 +109,174 @@ class Tulip8(tulip.Game):
         # game loop callback (runs every frame)
         tulip.frame_callback(self.main_loop)
 
-        self.load_rom(self.initial_rom_path)
+        if self.library.find(self.initial_rom or "") is not None:
+            self.load_rom(self.initial_rom)
+        elif self.library.entries:
+            self.load_rom(self.library.entries[0].name)
 
         pass
 
-    def load_rom(self, rom_path):
+    def load_rom(self, rom):
+        # rom is a file name in the library or a sha256 digest
 
         if self.chip8:
-            self.chip8.load_external_program(self.initial_rom_path)
+            entry = self.library.load(self.chip8, rom)
+            self.rom_index = self.library.entries.index(entry)
+            self.rewind.clear()
+            print("Tulip8: %s (%d bytes)" % (entry.name, entry.size))
         pass
 
+    def select_rom(self, step):
+        entries = self.library.entries
+        if entries:
+            self.load_rom(entries[(self.rom_index + step) % len(entries)].name)
+
+    def prepare_pixel_tiles(self):
+        # draws the tile atlas offscreen at the current scale and colors, for draw_byte
+        # to copy from; nothing to do if neither changed since the last call
+        scale = int(self.chip8.scale)
+        key = (scale, self.foreground_color, self.background_color)
+        if key == self.atlas_key:
+            return
+        self.atlas_key = key
+
+        tile_width = scale * 8
+        per_row = (atlas_right - atlas_left) // tile_width
+        self.tile_width = tile_width
+
+        for bits in range(256):
+            x = atlas_left + (bits % per_row) * tile_width
+            y = (bits // per_row) * scale
+            self.atlas_x[bits] = x
+            self.atlas_y[bits] = y
+
+            tulip.bg_rect(x, y, tile_width, scale, self.background_color, True)
+            # one rectangle per run of lit pixels
+            column = 0
+            while column < 8:
+                if (bits >> (7 - column)) & 1:
+                    start = column
+                    while column < 8 and (bits >> (7 - column)) & 1:
+                        column += 1
+                    tulip.bg_rect(
+                        x + start * scale,
+                        y,
+                        (column - start) * scale,
+                        scale,
+                        self.foreground_color,
+                        True,
+                    )
+                else:
+                    column += 1
+
+    def resolution_changed(self, columns, rows):
+        # fit the new display to the screen; the Chip8 redraws every pixel afterwards
+        self.chip8.scale = min(self.SCREEN_WIDTH // columns, self.SCREEN_HEIGHT // rows)
+        tulip.bg_clear()
+        # bg_clear wiped the atlas too
+        self.atlas_key = None
+        self.prepare_pixel_tiles()
+
     def async_chip8_tick(self):
         pass
 
     def main_loop(self, g):
-        self.chip8.cycle()
+        if self.held_keys and not self.chip8.auto_release:
+            self.release_keys()
+        self.chip8.run_frame()
+        self.rewind.capture()
+
+    def press_key(self, key):
+        # queued with the event's timestamp, applied at the start of the next batch
+        self.chip8.queue_key(key, True)
+        if key not in self.held_keys:
+            self.held_keys.append(key)
+
+    def release_keys(self):
+        # tulip.keys() is (modifiers, up to 6 scan codes) of the keys held right now
+        down = tulip.keys()[1:]
+        for key in self.held_keys[:]:
+            if self.scan_codes[key] not in down:
+                self.held_keys.remove(key)
+                self.chip8.queue_key(key, False)
 
     def play_beep(self, play=False):
-        if play:
-            amy.send(wave=amy.PULSE, osc=100, note=60, vel=1)
+        self.audio.update(self.chip8)
+
+    def send_audio(self, command):
+        # one AMY message per change, on our own oscillator only
+        if command[0] == "beep":
+            amy.send(osc=self.audio_osc, wave=amy.PULSE, duty=0.5, note=60, vel=1)
+        elif command[0] == "tone":
+            amy.send(osc=self.audio_osc, wave=amy.PULSE, freq=command[1], duty=command[2], vel=1)
         else:
-            amy.reset()
+            amy.send(osc=self.audio_osc, vel=0)
 
     def draw_pixel(self, x, y, pixel_scale, pixel_on=True):
 
         int_pixel_scale = int(pixel_scale)
 
-        if pixel_on:
-            # copy white bitmap from offscreen (1024, 0)
-            tulip.bg_blit(
-                1025,
-                0,
-                int_pixel_scale,
-                int_pixel_scale,
-                int(x) * int_pixel_scale,
-                int(y) * int_pixel_scale,
-            )
-            # tulip.bg_rect(int(x) * int_pixel_scale, int(y) * int_pixel_scale, int_pixel_scale, int_pixel_scale, self.foreground_color, self.render_filled)  # x and y are the center
+        # the first pixel of the all-on or all-off tile in the atlas
+        bits = 0xFF if pixel_on else 0x00
+        tulip.bg_blit(
+            self.atlas_x[bits],
+            self.atlas_y[bits],
+            int_pixel_scale,
+            int_pixel_scale,
+            int(x) * int_pixel_scale,
+            int(y) * int_pixel_scale,
+        )
 
-        else:
-            # copy black bitmap from offscreen (1024, pixel_scale)
-            tulip.bg_blit(
-                1025,
-                int_pixel_scale,
-                int_pixel_scale,
-                int_pixel_scale,
-                int(x) * int_pixel_scale,
-                int(y) * int_pixel_scale,
-            )
-            # tulip.bg_rect(int(x) * int_pixel_scale, int(y) * int_pixel_scale, int_pixel_scale, int_pixel_scale, self.background_color, self.render_filled)  # x and y are the center
+    def draw_byte(self, column, y, bits):
+        # one blit for 8 pixels, from the atlas tile of this bit pattern
+        tile_width = self.tile_width
+        scale = self.atlas_key[0]
+        tulip.bg_blit(
+            self.atlas_x[bits],
+            self.atlas_y[bits],
+            tile_width,
+            scale,
+            column * tile_width,
+            y * scale,
+        )
+
+    def set_keymap(self, keymap):
+        # keymap maps a keyboard character (a letter or digit) to a Chip-8 key 0x0-0xF,
+        # like chip8.key_map; letters match in either case
+        key_table = self.key_table
+        for code in range(256):
+            key_table[code] = 0xFF
+        for name, key in keymap.items():
+            key_table[ord(name.lower())] = key
+            key_table[ord(name.upper())] = key
+            self.scan_codes[key] = hid_scan_code(name)
 
     def keyboard_event_callback(self, key):
         # print("got key: %d" % (key))
 
-        if self.chip8:
-
-            if key in self.KEY_1:
-                self.chip8.key_press("1")
-
-            if key in self.KEY_2:
-                self.chip8.key_press("2")
-
-            if key in self.KEY_3:
-                self.chip8.key_press("3")
-
-            if key in self.KEY_4:
-                self.chip8.key_press("4")
-
-            if key in self.KEY_Q:
-                self.chip8.key_press("Q")
-
-            if key in self.KEY_W:
-                self.chip8.key_press("W")
-
-            if key in self.KEY_E:
-                self.chip8.key_press("E")
-
-            if key in self.KEY_R:
-                self.chip8.key_press("R")
-
-            if key in self.KEY_A:
-                self.chip8.key_press("A")
+        if self.chip8 and key < 256:
+            mapped_key = self.key_table[key]
+            if mapped_key != 0xFF:
+                self.press_key(mapped_key)
+                return
 
-            if key in self.KEY_S:
-                self.chip8.key_press("S")
-
-            if key in self.KEY_D:
-                self.chip8.key_press("D")
-
-            if key in self.KEY_F:
-                self.chip8.key_press("F")
-
-            if key in self.KEY_Z:
-                self.chip8.key_press("Z")
+        if key in self.KEY_ESC:
+            self.quit_app()
 
-            if key in self.KEY_X:
-                self.chip8.key_press("X")
+        elif key in self.KEY_BACKSPACE:
+            self.rewind.step_back(self.rewind_step_frames)
 
-            if key in self.KEY_C:
-                self.chip8.key_press("C")
+        elif key in self.KEY_N:
+            self.select_rom(1)
 
-            if key in self.KEY_V:
-                self.chip8.key_press("V")
+        elif key in self.KEY_B:
+            self.select_rom(-1)
 
-            pass
-
-        if key in self.KEY_ESC:
-            self.quit_app()
+        elif key in self.KEY_TAB:
+            if self.chip8.turbo == 1:
+                self.chip8.set_turbo(self.turbo_speed, self.turbo_frame_skip)
+            else:
+                self.chip8.set_turbo()
 
         elif key in self.KEY_P:
             # print(f"self.chip8.use_color_mode: {self.chip8.use_color_mode}")
@@ -216,7 +296,7 @@ class Tulip8(tulip.Game):
 
         self.chip8.reset()
 
-        amy.reset()
+        self.audio.stop()
         tulip.key_scan(0)
         tulip.frame_callback()
         tulip.bg_scroll()
@@ -231,6 +311,13 @@ class Tulip8(tulip.Game):
         print("stopping Tulip8, press ENTER")
 
 
+def hid_scan_code(name):
+    # USB HID usage id of a letter or digit key, as reported by tulip.keys()
+    if name.isdigit():
+        return 39 if name == "0" else 29 + int(name)
+    return 4 + ord(name.lower()) - ord("a")
+
+
 def quit(chip8=None):
 
     if chip8 != None: